@@ -11,6 +11,7 @@ from sklearn.linear_model import LinearRegression
 from sklearn.model_selection import train_test_split, KFold, RandomizedSearchCV, GridSearchCV, cross_val_score
 from sklearn.metrics import make_scorer, mean_absolute_error, mean_squared_error, r2_score
 from datetime import datetime, date
+from training_data import read_training_set
 
 # start time
 begin_time = datetime.now()
@@ -43,7 +44,7 @@ print("#####################################################")
 
 # import data
 dataset = '../../' + model_config['model']['loc'] + model_config['model']['file']
-dataset = pd.read_csv(dataset)
+dataset = read_training_set(dataset, model_config['meta']['predictors'] + model_config['meta']['target'])
 
 print("#####################################################")
 print("training data loaded")
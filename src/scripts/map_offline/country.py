@@ -1,12 +1,98 @@
-
 """LOAD DEPENDENCIES"""
+import numpy as np
 import geopandas as gp
 import shapely
-from urllib.request import urlopen
+from shapely.prepared import prep
+from functools import lru_cache
+from threading import RLock
 shapely.speedups.disable()
 
 from feature_engineering import configs
 
+
+"""COUNTRY GEOMETRY REGISTRY; BOUNDARIES ARE LOADED ONCE PER PROCESS"""
+_countries = None
+_country_geometries = {}
+# reentrant since country geometries are built from the boundaries while holding the lock
+_countries_lock = RLock()
+
+"""returns copy of world country boundaries; boundaries are loaded once and checked again once the lock is taken,
+so threads waiting for the first load do not load them again"""
+def get_countries():
+    global _countries
+    from data_gathering.downloads import get_download_manager
+    from data_gathering.opendata_utils import get_simplified
+
+    if _countries is None:
+        with _countries_lock:
+            if _countries is None:
+                # downloaded unless the file is already in the directory
+                path = get_download_manager().download('https://raw.githubusercontent.com/johan/world.geo.json/master/countries.geo.json', configs.WD + 'data/geodata/countries.json') ### Please edit the wd to your countries.json file dir!
+                _countries = get_simplified(gp.read_file(path), path)
+    return _countries.copy()
+
+
+"""CLASS THAT HOLDS GEOMETRY OF A COUNTRY IN THE REGISTRY; instances are shared by all callers and must not be modified"""
+class CountryGeometry:
+
+    def __init__(self, geodata):
+        self.geodata = geodata
+        self.country_name = geodata.name.values[0]
+        self.geometry = geodata.unary_union
+        self.prepared = prep(self.geometry)
+        self.bounds = self.geometry.bounds
+
+
+"""returns memoized geometry of the country with prepared geometry and bounding box; the shared instance is read-only"""
+def get_country_geometry(country_code):
+    if country_code not in _country_geometries:
+        with _countries_lock:
+            if country_code not in _country_geometries:
+                countries = get_countries()
+                if country_code.upper() in countries.id.values:
+                    _country_geometries[country_code] = CountryGeometry(countries[countries.id == country_code.upper()])
+                else:
+                    raise ValueError('Country code not exist!')
+    return _country_geometries[country_code]
+
+
+"""COUNTRY CLIPPING ENGINE"""
+
+"""returns parts of a simplified polygon lying inside the country; buffering inwards by twice the simplification tolerance keeps it inside the boundary.
+the memoized frame is shared by all callers and must not be modified"""
+@lru_cache(maxsize=None)
+def get_country_interior(country_code, tolerance):
+    country = get_country_geometry(country_code)
+    interior = country.geometry.buffer(-2 * tolerance).simplify(tolerance, preserve_topology=True)
+    parts = [i for i in getattr(interior, 'geoms', [interior]) if not i.is_empty]
+    return gp.GeoDataFrame(geometry=parts, crs='EPSG:4326')
+
+
+"""returns features of gdf within the country; features are filtered by bounding box first, features within the simplified
+interior are kept without further tests (spatial index query against interior parts) and the exact test runs only near the border"""
+def clip_to_country(gdf, country_code, tolerance=configs.CLIP_TOLERANCE):
+    country = get_country_geometry(country_code.upper())
+    minx, miny, maxx, maxy = country.bounds
+
+    bounds = gdf.geometry.bounds
+    candidates = gdf[((bounds.minx >= minx) & (bounds.miny >= miny) & (bounds.maxx <= maxx) & (bounds.maxy <= maxy)).values]
+
+    keep = np.zeros(len(candidates), dtype=bool)
+    positions = gp.GeoDataFrame(geometry=candidates.geometry.values, crs='EPSG:4326')
+    interior = get_country_interior(country_code.upper(), tolerance)
+    if len(interior) and len(candidates):
+        inside = gp.sjoin(positions, interior, how='inner', op='within').index.unique()
+        keep[inside] = True
+
+    # exact test for features near the border
+    border = positions[~keep]
+    if len(border):
+        boundary = gp.GeoDataFrame(geometry=[country.geometry], crs='EPSG:4326')
+        keep[gp.sjoin(border, boundary, how='inner', op='within').index.unique()] = True
+
+    return candidates[keep]
+
+
 """COUNTRY CLASS"""
 class Country:
 
@@ -19,17 +105,11 @@ class Country:
         self.set_country_geometry()
 
 
-    """sets geodata and country_name attributes"""
+    """sets geodata, country_name, prepared geometry and bounding box attributes; geodata is a copy the instance may modify"""
     def set_country_geometry(self):
-        try:
-            countries = gp.read_file(configs.WD + 'data/geodata/countries.json') ### Please edit the wd to your countries.json file dir!
-        except:
-            with urlopen('https://raw.githubusercontent.com/johan/world.geo.json/master/countries.geo.json') as response:
-                countries = gp.read_file(response)
-        
-        if self.country_code.upper() in countries.id.values:
-            self.geodata = countries[countries.id == self.country_code.upper()]
-            self.country_name = self.geodata.name.values[0]
-        else:
-            raise ValueError('Country code not exist!')
-        
+        country = get_country_geometry(self.country_code.upper())
+        self.geodata = country.geodata.copy()
+        self.country_name = country.country_name
+        self.geometry = country.geometry
+        self.prepared_geometry = country.prepared
+        self.bounds = country.bounds
@@ -1,5 +1,7 @@
 
 from . import opendata_utils
+from . import opendata_raster
+from . import downloads
 from . import opendata_scrap
 from . import opendata_facebook
 from . import opendata
@@ -0,0 +1,263 @@
+"""LOAD DEPENDENCIES"""
+import os
+import json
+import hashlib
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+
+"""LOAD MODULES"""
+from feature_engineering import configs
+
+
+"""STATUS CODES THAT ARE RETRIED"""
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+"""HTTP ERROR OF A RESPONSE THAT IS RETRIED"""
+class RetryableStatus(requests.HTTPError):
+    pass
+
+
+"""returns content of json file, None if it does not exist or is corrupt"""
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+"""writes json file atomically"""
+def write_json(path, content):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(content, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+"""removes file if it exists"""
+def remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+"""updates sha256 with content of file at path and returns it"""
+def update_sha256(sha256, path):
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024**2), b''):
+            sha256.update(chunk)
+    return sha256
+
+
+"""returns True if file at path matches size and sha256 of its download record; the checksum is computed again only if the file
+was modified since it was recorded, and the modification time of a verified file is recorded"""
+def is_intact(path, meta):
+    stat = os.stat(path)
+    if meta.get('size') != stat.st_size:
+        return False
+    if meta.get('sha256') is None or meta.get('mtime') == stat.st_mtime:
+        return True
+
+    if update_sha256(hashlib.sha256(), path).hexdigest() != meta['sha256']:
+        return False
+    write_json(path + '.json', dict(meta, mtime=stat.st_mtime))
+    return True
+
+
+"""CLASS THAT LIMITS CONCURRENT REQUESTS TO A HOST AND SPACES THEIR STARTS BY min_interval SECONDS"""
+class HostLimit:
+
+    def __init__(self, workers, min_interval=0):
+        self.semaphore = threading.BoundedSemaphore(workers)
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_start = 0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            start = max(time.monotonic(), self.next_start)
+            self.next_start = start + self.min_interval
+        time.sleep(max(start - time.monotonic(), 0))
+        return self
+
+    def __exit__(self, *args):
+        self.semaphore.release()
+
+
+"""DOWNLOAD MANAGER CLASS"""
+class DownloadManager:
+    """
+    Shared downloader of multi-file sources; connections are pooled in one session, downloads run in a bounded thread pool
+    with a concurrency limit and an optional minimum interval between request starts per host, and failed requests are retried with exponential backoff
+    """
+    def __init__(self, max_workers=configs.DOWNLOAD_WORKERS, host_workers=configs.DOWNLOAD_HOST_WORKERS, retries=configs.DOWNLOAD_RETRIES, backoff=configs.DOWNLOAD_BACKOFF, timeout=configs.DOWNLOAD_TIMEOUT, min_interval=0):
+        self.max_workers = max_workers
+        self.host_workers = host_workers
+        self.min_interval = min_interval
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.hosts = {}
+        self.hosts_lock = threading.Lock()
+
+
+    """returns limit of concurrent requests to the host of url"""
+    def get_host_limit(self, url):
+        host = urlparse(url).netloc
+        with self.hosts_lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostLimit(self.host_workers, self.min_interval)
+            return self.hosts[host]
+
+
+    """returns handler(response) of streamed GET request of url; the host slot is held until the handler consumed the response.
+    connection errors, timeouts and RETRY_STATUS responses are retried with exponential backoff"""
+    def fetch(self, url, handler=lambda response: response.content, **kwargs):
+        for attempt in range(self.retries + 1):
+            try:
+                with self.get_host_limit(url):
+                    with self.session.get(url, stream=True, timeout=self.timeout, **kwargs) as response:
+                        if response.status_code not in RETRY_STATUS:
+                            response.raise_for_status()
+                            return handler(response)
+                        error = RetryableStatus(str(response.status_code) + ' response from ' + url, response=response)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = e
+
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** attempt)
+
+        raise error
+
+
+    """returns handler(response) of each url in order, urls are downloaded concurrently"""
+    def map(self, urls, handler=lambda response: response.content, **kwargs):
+        urls = list(urls)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self.fetch, url, handler, **kwargs) for url in urls]
+            return [future.result() for future in tqdm(futures)]
+
+
+    """downloads url to path and returns path; the download is written to path.part and moved in place once complete, interrupted downloads
+    resume with Range requests, and url, ETag, Last-Modified, size, sha256 and modification time are recorded in path.json. existing downloads
+    are verified against the record and downloaded again if they do not match, then revalidated with conditional requests and kept if the server
+    reports them unchanged or cannot be reached; files without record are used as they are"""
+    def download(self, url, path, revalidate=configs.DOWNLOAD_REVALIDATE):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        meta = read_json(path + '.json')
+
+        if os.path.exists(path):
+            if meta is None:
+                return path
+            if not is_intact(path, meta):
+                print(path + ' does not match the size and checksum of its download record, downloading again...')
+            elif not revalidate:
+                return path
+            else:
+                try:
+                    if not self.is_modified(url, meta):
+                        return path
+                except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+                    print('Unable to revalidate ' + path + ', using the local copy.')
+                    return path
+                print(url + ' has changed, downloading again...')
+            meta = None
+            remove_file(path + '.part')
+
+        for attempt in range(self.retries + 1):
+            try:
+                with self.get_host_limit(url):
+                    return self.transfer(url, path)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError, RetryableStatus) as e:
+                error = e
+            if attempt < self.retries:
+                print('Download of ' + url + ' interrupted, resuming...')
+                time.sleep(self.backoff * 2 ** attempt)
+
+        raise error
+
+
+    """returns True unless a conditional request shows url did not change since the recorded download"""
+    def is_modified(self, url, meta):
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        if not headers:
+            return False
+
+        with self.get_host_limit(url):
+            with self.session.get(url, stream=True, timeout=self.timeout, headers=headers) as response:
+                if response.status_code == 304:
+                    return False
+                response.raise_for_status()
+                return (response.headers.get('ETag'), response.headers.get('Last-Modified')) != (meta.get('etag'), meta.get('last_modified'))
+
+
+    """transfers url to path.part, resuming a partial download of the same version, and moves it to path"""
+    def transfer(self, url, path):
+        part = path + '.part'
+        part_meta = read_json(part + '.json')
+        offset = os.path.getsize(part) if os.path.exists(part) and part_meta is not None and part_meta.get('url') == url else 0
+
+        # content is stored as sent, so sizes and checksums refer to the file itself
+        headers = {'Accept-Encoding': 'identity'}
+        validator = part_meta and (part_meta.get('etag') or part_meta.get('last_modified'))
+        if offset and validator:
+            headers.update({'Range': 'bytes=' + str(offset) + '-', 'If-Range': validator})
+
+        with self.session.get(url, stream=True, timeout=self.timeout, headers=headers) as response:
+            if response.status_code in RETRY_STATUS:
+                raise RetryableStatus(str(response.status_code) + ' response from ' + url)
+            if response.status_code == 416:
+                # partial file does not match the remote file anymore
+                remove_file(part)
+                raise RetryableStatus('416 response from ' + url)
+            response.raise_for_status()
+
+            # server ignores the range or the file changed since the partial download
+            if response.status_code != 206:
+                offset = 0
+
+            sha256 = update_sha256(hashlib.sha256(), part) if offset else hashlib.sha256()
+
+            if offset:
+                record = dict(part_meta)
+            else:
+                record = {'url': url, 'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+                write_json(part + '.json', record)
+
+            size = int(response.headers['Content-Length']) + offset if 'Content-Length' in response.headers else None
+            with open(part, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1024**2):
+                    f.write(chunk)
+                    sha256.update(chunk)
+
+        if size is not None and os.path.getsize(part) != size:
+            raise requests.exceptions.ChunkedEncodingError('Incomplete download of ' + url)
+
+        record.update({'size': os.path.getsize(part), 'sha256': sha256.hexdigest(), 'mtime': os.path.getmtime(part)})
+        os.replace(part, path)
+        write_json(path + '.json', record)
+        remove_file(part + '.json')
+        return path
+
+
+"""returns download manager shared by the data sources of the process"""
+@lru_cache(maxsize=None)
+def get_download_manager():
+    return DownloadManager()
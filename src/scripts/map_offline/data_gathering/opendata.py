@@ -5,7 +5,9 @@ import geopandas as gp
 import os
 
 from data_gathering.opendata_utils import *
+from data_gathering.opendata_raster import *
 from data_gathering.opendata_scrap import *
+from data_gathering.downloads import get_download_manager
 from school import *
 from data_gathering.opendata_facebook import *
 from feature_engineering import configs
@@ -25,55 +27,102 @@ class OpenData:
         country = Country(self.country_code)
         self.country_geo = country.geodata
         self.country_name = country.country_name
+        self.country_geometry = country.geometry
+        self.country_prepared = country.prepared_geometry
+        self.country_bounds = country.bounds
 
 
 """"POPULATION DATA CLASS"""
 class PopulationData(OpenData):
 
-    def __init__(self, country_code, wd = 'worldpop/', year= configs.POPULATION_DATASET_YEAR):
+    def __init__(self, country_code, wd = 'worldpop/', locations = None, year= configs.POPULATION_DATASET_YEAR, coverage = configs.POPULATION_COVERAGE, join = configs.POPULATION_JOIN, buffer = configs.SCHOOL_BUFFER, block_size = configs.RASTER_BLOCK_SIZE):
         super().__init__(country_code)
         self.wd = self.base_wd + wd
+        self.locations = locations
         self.year = year
+        self.coverage = coverage
+        self.join = join
+        self.buffer = buffer
+        self.block_size = block_size
         self.set_pop_data()
 
     def set_pop_data(self):
 
-        file_name = 'school_agg_pop_'+self.country_code.lower()+'.csv'
+        file_name = get_pop_cache_name(self.country_code, self.year, self.join, self.coverage, self.buffer)
+        migrate_legacy_cache(self.wd, file_name, get_legacy_pop_cache_name(self.country_code, self.year, self.join, self.coverage, self.buffer))
+        pop_url, pop_name = get_pop_url(self.country_code, self.year)
+        index_path = self.wd + pop_name[:-4] + '_sat'
+
+        # INTEGRAL IMAGE ANSWERS BUFFER QUERIES DIRECTLY; JOINED DATA IS RECOMPUTED FROM THE INDEX ON EVERY RUN
+        if self.join != 'integral' and cache_exists(self.wd + file_name):
+            print('Reading joined population data...')
+            try:
+                self.data = read_cache(self.wd + file_name)
+            except:
+                raise RuntimeError('Unable to read ' + file_name)
 
-        if os.path.exists(self.wd + file_name):
-            print('No need to read raw population data; school joined data is exist in directory!')
-            self.data = None
-            
         else:
-            pop_url, pop_name = get_pop_url(self.country_code, self.year)
-            # CHECK tif FILE IS ALREADY IN THE DIRECTORY
-            if os.path.exists(self.wd + pop_name):
-                print('Reading population tif file...')
-                try:
-                    pop = gdal.Open(self.wd + pop_name)
-                except:
-                    raise RuntimeError('Unable to open ' + pop_name)
+            if self.locations is None:
+                raise ValueError('Locations data frame should be provided!')
+            if not set(['source_school_id', 'latitude', 'longitude', 'geometry']).issubset(self.locations.columns):
+                raise ValueError('Locations data frame should include source_school_id, latitude, longitude and geometry columns!')
+
+            if self.join == 'integral' and os.path.exists(index_path + '.npy'):
+                print('Reading population integral image...')
+                pop = IntegralImage(index_path)
 
             else:
-                print('Downloading population data...')
+                # DOWNLOAD tif FILE UNLESS UNCHANGED COPY IS ALREADY IN THE DIRECTORY
+                print('Getting population tif file...')
                 try:
-                    pop = gdal.Open(pop_url)
+                    pop_path = get_download_manager().download(pop_url, self.wd + pop_name)
                 except:
                     raise RuntimeError('Unable to download from ' + pop_url)
 
-            self.data = tif_to_gdf(pop)
+                try:
+                    pop = gdal.Open(pop_path)
+                except:
+                    raise RuntimeError('Unable to open ' + pop_name)
+
+                if self.join == 'integral':
+                    print('Building population integral image...')
+                    pop = build_integral_image(pop, index_path, self.block_size)
+
+            self.data = self.pop_prep(pop)
+
+
+    def pop_prep(self, pop):
+
+        print('Summing population within school buffers...')
+        if isinstance(pop, IntegralImage):
+            population, pixels = pop.buffer_sum(self.locations.longitude, self.locations.latitude, self.buffer/100)
+        else:
+            population, pixels = zonal_sum(pop, self.locations.geometry, fractional = self.coverage == 'fractional', block_size = self.block_size)
+
+        # keep schools covering at least one pixel
+        self.data = pd.DataFrame({'source_school_id': self.locations.source_school_id.values, 'population': population})
+        self.data = self.data[pixels > 0]
+
+        print('Writing joined population data to directory...')
+        write_cache(self.data, self.wd + get_pop_cache_name(self.country_code, self.year, self.join, self.coverage, self.buffer))
+
+        return self.data
 
 
 
 """SPEEDTEST DATA CLASS"""
 class SpeedtestData(OpenData):
 
-    def __init__(self, country_code, wd='speedtest/', type=configs.SPEEDTEST_TILE_TYPE, year=configs.SPEEDTEST_TILE_YEAR, quarter=configs.SPEEDTEST_TILE_QUARTER):
+    # quadkey and test counts are kept for the quadkey join of tiles to schools
+    columns = ['quadkey', 'avg_d_kbps', 'avg_u_kbps', 'tests']
+
+    def __init__(self, country_code, wd='speedtest/', type=configs.SPEEDTEST_TILE_TYPE, year=configs.SPEEDTEST_TILE_YEAR, quarter=configs.SPEEDTEST_TILE_QUARTER, batch_size=configs.SPEEDTEST_BATCH_SIZE):
         super().__init__(country_code)
         self.wd = self.base_wd + wd
         self.type = type
         self.year = year
         self.quarter = quarter
+        self.batch_size = batch_size
         self.tile_url, self.tile_name = get_speedtest_url(self.type, self.year, self.quarter)
         self.set_speedtest_data()
 
@@ -81,43 +130,44 @@ class SpeedtestData(OpenData):
         country_tile_path = self.wd + self.tile_name[:-4] + '_' + self.country_code.lower() + '.csv'
 
         # CHECK IF COUNTRY SPEEDTEST DATA IS ALREADY IN THE DIRECTORY
-        if os.path.exists(country_tile_path):
+        if cache_exists(country_tile_path):
             print('Reading speedtest data for ' + self.country_name + '...')
-            df_tiles = pd.read_csv(country_tile_path)
-            gdf_tiles = df_to_gdf(df_tiles)
-            self.data = gdf_tiles[['avg_d_kbps', 'avg_u_kbps', 'geometry']]
+            gdf_tiles = read_cache(country_tile_path)
+            self.data = gdf_tiles[[i for i in self.columns + ['geometry'] if i in gdf_tiles]]
         else:
-            # CHECK SPEEDTEST DATA IS ALREADY IN THE DIRECTORY
-            if os.path.exists(self.wd + str(self.tile_name)):
-                print('Reading speedtest data...')
-                try:
-                    gdf_tiles = gp.read_file(self.wd + str(self.tile_name))
-                    self.data = gdf_tiles
-                    print('Getting tiles for ' + self.country_name + '...')
-                    self.data = self.tile_prep()
-                except:
-                    raise RuntimeError('Unable to read ' + self.tile_name)
+            # DOWNLOAD SPEEDTEST DATA UNLESS UNCHANGED COPY IS ALREADY IN THE DIRECTORY; INTERRUPTED DOWNLOADS ARE RESUMED
+            print('Getting speedtest data...')
+            try:
+                tile_path = get_download_manager().download(self.tile_url, self.wd + str(self.tile_name))
+            except:
+                raise RuntimeError('Unable to download from ' + self.tile_url)
 
-            else:
-                print('Downloading speedtest data...')
-                try:
-                    gdf_tiles = gp.read_file(self.tile_url)
-                    self.data = gdf_tiles
-                    print('Getting tiles for ' + self.country_name + '...')
-                    self.data = self.tile_prep()
-                except:
-                    raise RuntimeError('Unable to download from ' + self.tile_url)
+            print('Reading speedtest data...')
+            try:
+                self.data = self.read_tiles(tile_path)
+            except:
+                raise RuntimeError('Unable to read ' + self.tile_name)
 
-    
-    def tile_prep(self):
-        tiles = gp.sjoin(self.data, self.country_geo, how="inner", op="within")
-        tiles = tiles[['avg_d_kbps', 'avg_u_kbps', 'geometry']]
+            print('Writing country speedtest data to directory...')
+            write_cache(self.data, country_tile_path)
 
-        country_tile_path = self.wd + self.tile_name[:-4] + '_' + self.country_code.lower() + '.csv'
 
-        print('Writing country speedtest data to directory...')
-        tiles.to_csv(country_tile_path, index=False)
-        return tiles
+    """streams tiles within the country bounding box in batches and keeps the ones within the country"""
+    def read_tiles(self, path):
+        print('Getting tiles for ' + self.country_name + '...')
+        tiles = []
+        for batch in tqdm(read_file_batches(path, bbox=self.country_bounds, columns=self.columns, batch_size=self.batch_size)):
+            self.data = batch
+            tiles.append(self.tile_prep())
+
+        if len(tiles) == 0:
+            return gp.GeoDataFrame(columns=self.columns + ['geometry'], geometry='geometry', crs='EPSG:4326')
+        return gp.GeoDataFrame(pd.concat(tiles, ignore_index=True), crs='EPSG:4326')
+
+    
+    def tile_prep(self):
+        tiles = clip_to_country(self.data, self.country_code)
+        return tiles[self.columns + ['geometry']]
 
 
 """FACEBOOK DATA CLASS"""
@@ -135,12 +185,15 @@ class FacebookData(OpenData):
     
     def set_fb_data(self):
 
-        file_name = 'facebook_' + self.country_code.lower() + '_' + str(configs.FACEBOOK_SCHOOL_DATA_LEN[self.country_code.lower()]) + '.csv'
+        # schools the dataset is collected for are recorded in the name, reader and writer use the configured number
+        n_schools = configs.FACEBOOK_SCHOOL_DATA_LEN[self.country_code.lower()]
+        file_name = get_facebook_cache_name(self.country_code, n_schools, self.radius)
+        migrate_legacy_cache(self.wd, file_name, get_legacy_facebook_cache_name(self.country_code, n_schools, self.radius))
 
-        if os.path.exists(self.wd + file_name):
+        if cache_exists(self.wd + file_name):
             print('Reading facebook data...')
             try:
-                self.data = pd.read_csv(self.wd + file_name)
+                self.data = read_cache(self.wd + file_name)
             except:
                 raise RuntimeError('Unable to read facebook data!')
 
@@ -153,7 +206,7 @@ class FacebookData(OpenData):
             try:
                 self.data = get_delivery_estimate(self.locations, self.access_token, self.ad_account_id, self.call_limit, self.radius)
                 print('Writing facebook data to directory...')
-                self.data.to_csv(self.wd + 'facebook_' + self.country_code.lower() + '_' + str(len(self.locations)) + '.csv', index=False)
+                write_cache(self.data, self.wd + file_name)
             except:
                 raise RuntimeError('Unable to call the Facebook Marketing API!')
 
@@ -161,26 +214,26 @@ class FacebookData(OpenData):
 """OPENCELL DATA CLASS"""
 class OpencellData(OpenData):
 
-    def __init__(self, country_code, wd = 'opencellid/', access_token=configs.OPENCELLID_ACCESS_TOKEN):
+    def __init__(self, country_code, wd = 'opencellid/', access_token=configs.OPENCELLID_ACCESS_TOKEN, chunk_size=configs.OPENCELL_CHUNK_SIZE):
         super().__init__(country_code)
         self.wd = self.base_wd + wd
         self.access_token = access_token
+        self.chunk_size = chunk_size
         self.set_cell_data()
 
     def set_cell_data(self):
 
-        if os.path.exists(self.wd + self.country_code + '.csv.gz'):
+        if cache_exists(self.wd + self.country_code + '.csv.gz'):
             print('Reading cell data...')
             try:
-                self.data = pd.read_csv(self.wd + self.country_code + '.csv.gz')
-                self.data = df_to_gdf(self.data)
+                self.data = read_cache(self.wd + self.country_code + '.csv.gz')
             except:
                 raise RuntimeError('Unable to read cell data!')
 
         else:
             try:
                 print('Downloading cell data...')
-                self.data = get_cell_data(self.country_code, self.access_token, self.wd)
+                self.data = get_cell_data(self.country_code, self.access_token, self.chunk_size)
                 print('Preprocessing cell data...')
                 self.data = self.cell_prep()
             except:
@@ -189,24 +242,13 @@ class OpencellData(OpenData):
     
     def cell_prep(self):
 
-        # Categorize radio
-        self.data['radio'] = self.data.radio.astype('category')
-
-        # Created and updated to datetime integers
-        self.data['created'] = pd.to_datetime(self.data['created'], unit='s', origin='unix')
-        self.data['updated'] = pd.to_datetime(self.data['updated'], unit='s', origin='unix')
-
-        # Filter out outliers created before 2003
-        self.data = self.data[self.data.created.dt.year >= 2003]
-
-        self.data['geometry'] = [Point(i, j) for i,j in zip(self.data.lon, self.data.lat)]
-
-        self.data = self.data[['radio', 'range', 'geometry']]
+        # radio is categorized and cells created before 2003 are filtered out while reading
+        self.data = gp.GeoDataFrame(self.data[['radio', 'range']], geometry=gp.points_from_xy(self.data.lon, self.data.lat), crs='EPSG:4326')
 
         print('Writing country opencellid data to directory...')
-        self.data.to_csv(self.wd + self.country_code + '.csv.gz', compression='gzip', index=False)
+        write_cache(self.data, self.wd + self.country_code + '.csv.gz')
 
-        return gp.GeoDataFrame(self.data)
+        return self.data
 
         
 
@@ -218,6 +260,8 @@ class SatelliteData(OpenData):
         self.wd = self.base_wd + wd
         self.collection_band = configs.SATELITTE_COLLECTIONS
         self.locations = locations
+        self.file_name = get_satellite_cache_name(country_code, self.collection_band, start_year, end_year, buffer, scale)
+        self.legacy_name = get_legacy_satellite_cache_name(country_code, self.collection_band, start_year, end_year, buffer, scale)
         self.buffer = buffer * 1000
         self.max_call_size = max_call_size
         self.scale = scale
@@ -238,9 +282,10 @@ class SatelliteData(OpenData):
     
     def set_satellite_data(self):
 
-        if os.path.exists(self.wd + 'satellite_' + self.country_code.lower() + '.csv'):
+        migrate_legacy_cache(self.wd, self.file_name, self.legacy_name)
+        if cache_exists(self.wd + self.file_name):
             print('Reading satellite data from directory...')
-            self.data = pd.read_csv(self.wd + 'satellite_' + self.country_code + '.csv')
+            self.data = read_cache(self.wd + self.file_name)
         else:
             if self.locations is None:
                 raise ValueError('Locations data frame should be provided!')
@@ -251,4 +296,4 @@ class SatelliteData(OpenData):
             self.data = get_satellite_data(self.collection_band, self.locations, self.json_key_path, self.ee_service_account, self.buffer, self.max_call_size, self.start_year, self.end_year, self.scale)
             
             print('Writing satellite data to directory...')
-            self.data.to_csv(self.wd + 'satellite_' + self.country_code.lower() + '.csv', index=False)
\ No newline at end of file
+            write_cache(self.data, self.wd + self.file_name)
\ No newline at end of file
@@ -0,0 +1,211 @@
+
+"""LOAD DEPENDENCIES"""
+import os
+import json
+import numpy as np
+import geopandas as gp
+from tqdm import tqdm
+try:
+    from shapely import contains_xy
+except ImportError:
+    from shapely.vectorized import contains as contains_xy
+
+
+"""RASTER ZONAL STATISTICS"""
+
+"""returns pixel windows (col_off, row_off, col_end, row_end) covering the bounding boxes of geometries, clipped to the raster extent"""
+def get_raster_windows(tif, geometries):
+    gt = tif.GetGeoTransform()
+    bounds = gp.GeoSeries(geometries).bounds.to_numpy()
+
+    cols = (bounds[:, [0, 2]] - gt[0]) / gt[1]
+    rows = (bounds[:, [3, 1]] - gt[3]) / gt[5]
+
+    windows = np.column_stack([np.floor(cols[:, 0]), np.floor(rows[:, 0]), np.ceil(cols[:, 1]), np.ceil(rows[:, 1])])
+    windows = np.nan_to_num(windows, nan=0).astype('int64')
+    windows[:, [0, 2]] = np.clip(windows[:, [0, 2]], 0, tif.RasterXSize)
+    windows[:, [1, 3]] = np.clip(windows[:, [1, 3]], 0, tif.RasterYSize)
+
+    return windows
+
+
+"""returns share of each pixel in the window covered by geometry; pixels are sampled on a supersample x supersample grid, supersample=1 tests pixel centres only"""
+def pixel_coverage(geometry, gt, window, supersample=1):
+    col_off, row_off, col_end, row_end = window
+    offsets = (np.arange(supersample) + 0.5) / supersample
+
+    x = gt[0] + (np.arange(col_off, col_end)[:, None] + offsets).ravel() * gt[1]
+    y = gt[3] + (np.arange(row_off, row_end)[:, None] + offsets).ravel() * gt[5]
+    xx, yy = np.meshgrid(x, y)
+
+    inside = contains_xy(geometry, xx, yy)
+    inside = inside.reshape(row_end - row_off, supersample, col_end - col_off, supersample)
+
+    return inside.mean(axis=(1, 3))
+
+
+"""returns block width and height raster band is read in; the native GDAL block size unless block_size is given"""
+def get_block_size(srcband, block_size=None):
+    if block_size is None:
+        return srcband.GetBlockSize()
+    return block_size, block_size
+
+
+"""returns indices of the windows intersecting each block as a dict keyed by block offset (col_off, row_off); windows are
+bucketed once, so blocks look up their windows instead of testing all windows"""
+def get_window_blocks(windows, xblock, yblock):
+    col_blocks = np.column_stack([windows[:, 0] // xblock, (windows[:, 2] - 1) // xblock])
+    row_blocks = np.column_stack([windows[:, 1] // yblock, (windows[:, 3] - 1) // yblock])
+
+    blocks = {}
+    for i in range(len(windows)):
+        for by in range(row_blocks[i, 0], row_blocks[i, 1] + 1):
+            for bx in range(col_blocks[i, 0], col_blocks[i, 1] + 1):
+                blocks.setdefault((bx * xblock, by * yblock), []).append(i)
+    return {key: np.array(value) for key, value in blocks.items()}
+
+
+"""yields (window, values) blocks of raster band as float64 arrays with nodata set to 0; window is (col_off, row_off, col_end, row_end).
+blocks default to the native GDAL block size; if windows are given, blocks not intersecting any of them are not read, blocks holding only nodata are skipped unless skip_nodata is False"""
+def iter_raster_blocks(tif, block_size=None, windows=None, band=1, skip_nodata=True):
+    srcband = tif.GetRasterBand(band)
+    nodata = srcband.GetNoDataValue()
+    xsize, ysize = tif.RasterXSize, tif.RasterYSize
+    xblock, yblock = get_block_size(srcband, block_size)
+    blocks = get_window_blocks(windows, xblock, yblock) if windows is not None else None
+
+    for row_off in range(0, ysize, yblock):
+        row_end = min(row_off + yblock, ysize)
+
+        for col_off in range(0, xsize, xblock):
+            col_end = min(col_off + xblock, xsize)
+
+            if blocks is not None and (col_off, row_off) not in blocks:
+                continue
+
+            values = srcband.ReadAsArray(col_off, row_off, col_end - col_off, row_end - row_off).astype('float64')
+            empty = ~np.isfinite(values)
+            if nodata is not None:
+                empty |= values == nodata
+
+            if skip_nodata and empty.all():
+                continue
+
+            values[empty] = 0
+            yield (col_off, row_off, col_end, row_end), values
+
+
+"""returns sum of raster values and number of covered pixels within each geometry; raster is streamed block by block so memory depends on the block size only.
+nodata pixels count as covered pixels of value 0 as in the integral image, so a geometry over nodata only gets a pixel count with sum 0"""
+def zonal_sum(tif, geometries, fractional=False, supersample=8, band=1, block_size=None):
+    gt = tif.GetGeoTransform()
+
+    geometries = gp.GeoSeries(geometries).reset_index(drop=True)
+    windows = get_raster_windows(tif, geometries)
+    valid = (windows[:, 2] > windows[:, 0]) & (windows[:, 3] > windows[:, 1]) & geometries.notna().to_numpy()
+    supersample = supersample if fractional else 1
+
+    # windows of each block, as indices into geometries
+    index = np.flatnonzero(valid)
+    blocks = get_window_blocks(windows[index], *get_block_size(tif.GetRasterBand(band), block_size))
+
+    sums = np.zeros(len(geometries))
+    counts = np.zeros(len(geometries))
+
+    for (col_off, row_off, col_end, row_end), values in tqdm(iter_raster_blocks(tif, block_size, windows[index], band, skip_nodata=False)):
+        for i in index[blocks[(col_off, row_off)]]:
+            # part of the geometry window falling into this block
+            window = (max(windows[i, 0], col_off), max(windows[i, 1], row_off), min(windows[i, 2], col_end), min(windows[i, 3], row_end))
+            block_values = values[window[1] - row_off:window[3] - row_off, window[0] - col_off:window[2] - col_off]
+
+            coverage = pixel_coverage(geometries[i], gt, window, supersample)
+            sums[i] += (block_values * coverage).sum()
+            counts[i] += coverage.sum()
+
+    return sums, counts
+
+
+"""SUMMED AREA TABLE INDEX"""
+
+"""builds summed area table of raster band strip by strip and saves it as path.npy with geotransform in path.json"""
+def build_integral_image(tif, path, block_size=512, band=1):
+    srcband = tif.GetRasterBand(band)
+    nodata = srcband.GetNoDataValue()
+    xsize, ysize = tif.RasterXSize, tif.RasterYSize
+    block_size = block_size or 512
+
+    sat = np.lib.format.open_memmap(path + '.npy.tmp', mode='w+', dtype='float64', shape=(ysize + 1, xsize + 1))
+    sat[0, :] = 0
+    sat[:, 0] = 0
+
+    for row_off in tqdm(range(0, ysize, block_size)):
+        rows = min(block_size, ysize - row_off)
+        values = srcband.ReadAsArray(0, row_off, xsize, rows).astype('float64')
+        values[~np.isfinite(values)] = 0
+        if nodata is not None:
+            values[values == nodata] = 0
+
+        # cumulative sums within strip, carried over from the last row of the previous strip
+        sat[row_off + 1:row_off + rows + 1, 1:] = values.cumsum(axis=0).cumsum(axis=1) + sat[row_off, 1:]
+
+    sat.flush()
+    del sat
+    os.replace(path + '.npy.tmp', path + '.npy')
+
+    with open(path + '.json', 'w') as f:
+        json.dump({'geotransform': list(tif.GetGeoTransform()), 'shape': [ysize, xsize]}, f)
+
+    return IntegralImage(path)
+
+
+"""CLASS THAT HOLDS SUMMED AREA TABLE OF A RASTER"""
+class IntegralImage:
+
+    def __init__(self, path):
+        self.path = path
+        self.sat = np.load(path + '.npy', mmap_mode='r')
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.gt = meta['geotransform']
+        self.ysize, self.xsize = meta['shape']
+
+
+    """returns sums and pixel counts of rectangles [row_off, row_end) x [col_off, col_end), vectorized over arrays of windows"""
+    def rect_sum(self, col_off, row_off, col_end, row_end):
+        col_off = np.clip(col_off, 0, self.xsize).astype('int64')
+        col_end = np.clip(col_end, 0, self.xsize).astype('int64')
+        row_off = np.clip(row_off, 0, self.ysize).astype('int64')
+        row_end = np.clip(row_end, 0, self.ysize).astype('int64')
+        col_end = np.maximum(col_end, col_off)
+        row_end = np.maximum(row_end, row_off)
+
+        sums = self.sat[row_end, col_end] - self.sat[row_off, col_end] - self.sat[row_end, col_off] + self.sat[row_off, col_off]
+        counts = (col_end - col_off) * (row_end - row_off)
+        return sums, counts
+
+
+    """returns sums and pixel counts of circular buffers around x, y; pixels with centre in the circle are summed one pixel row at a time, so cost depends on the radius only"""
+    def buffer_sum(self, x, y, radius):
+        px = (np.asarray(x, dtype='float64') - self.gt[0]) / self.gt[1]
+        py = (np.asarray(y, dtype='float64') - self.gt[3]) / self.gt[5]
+        ry = radius / abs(self.gt[5])
+
+        sums = np.zeros(len(px))
+        counts = np.zeros(len(px), dtype='int64')
+
+        row_start = np.ceil(py - ry - 0.5)
+        for k in range(int(np.ceil(2 * ry)) + 1):
+            row = row_start + k
+            dy = (row + 0.5 - py) * abs(self.gt[5])
+            inside = np.abs(dy) < radius
+
+            # half width of the circle at the pixel row centre, in pixels
+            hw = np.sqrt(np.where(inside, radius**2 - dy**2, 0)) / self.gt[1]
+            col_off = np.where(inside, np.floor(px - hw - 0.5) + 1, 0)
+            col_end = np.where(inside, np.ceil(px + hw - 0.5), 0)
+
+            row_sums, row_counts = self.rect_sum(col_off, row, col_end, np.where(inside, row + 1, row))
+            sums += row_sums
+            counts += row_counts
+
+        return sums, counts
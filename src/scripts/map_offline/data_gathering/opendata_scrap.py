@@ -1,16 +1,29 @@
 
 """LOAD DEPENDENCIES"""
 import pandas as pd
+import numpy as np
 from bs4 import BeautifulSoup
 from datetime import datetime
 from tqdm import tqdm
-import geojson
 import json
 from shapely.geometry import Point
 import requests
 import logging
 import gzip
+import io
 import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from urllib.parse import urlencode
+from shapely.geometry import box
+
+
+"""LOAD MODULES"""
+from feature_engineering import configs
+from country import get_country_geometry
+from data_gathering.downloads import DownloadManager, get_download_manager, read_json, write_json
+
 
 """POPULATION DATA"""
 
@@ -85,45 +98,69 @@ def get_opencell_url(country_code, token):
     return links
 
 
-"""GET OPENCELLID DATA"""
-def get_cell_data(country_code, token, wd):
+"""OPENCELLID COLUMNS AND DTYPES KEPT WHILE READING"""
+CELL_DTYPES = {'radio': 'category', 'lon': 'float64', 'lat': 'float64', 'range': 'float32', 'created': 'int64', 'updated': 'int64'}
+CELL_MIN_CREATED = int((datetime(2003, 1, 1) - datetime(1970, 1, 1)).total_seconds()) # unix time of 2003-01-01
+
+
+"""READS GZIPPED OPENCELLID CSV STREAM CHUNK BY CHUNK; KEEPS PROJECTED COLUMNS OF CELLS CREATED FROM 2003 ON"""
+def read_cell_stream(stream, chunksize=500000):
+    chunks = []
+    with gzip.GzipFile(fileobj=stream) as feed_data:
+        for chunk in pd.read_csv(feed_data, usecols=list(CELL_DTYPES), dtype=CELL_DTYPES, chunksize=chunksize):
+            # filter out outliers created before 2003
+            chunks.append(chunk[chunk.created >= CELL_MIN_CREATED])
+
+    if len(chunks) == 0:
+        return pd.DataFrame({i: pd.Series(dtype=j) for i, j in CELL_DTYPES.items()})
+    return pd.concat(chunks, ignore_index=True)
+
+
+"""READS OPENCELLID MCC FILE FROM HTTP RESPONSE WHILE IT IS DOWNLOADED"""
+def read_cell_response(response, chunksize=500000):
+    feed = io.BufferedReader(response.raw)
+
+    # error messages are sent as plain text instead of gzip
+    if feed.peek(2)[:2] != b'\x1f\x8b':
+        contents = feed.read().decode(errors='replace')
+        if 'RATE_LIMITED' in contents:
+            logging.error("Feed did not update. You're rate-limited!")
+        elif 'INVALID_TOKEN' in contents:
+            logging.error("API token rejected by Unwired Labs!!")
+        else:
+            logging.error("Non-specific error. Details: %s", contents[:200])
+        raise IOError('Unable to read OpenCelliD feed ' + response.url)
+
+    return read_cell_stream(feed, chunksize)
+
+
+"""GET OPENCELLID DATA; MCC FILES ARE DOWNLOADED CONCURRENTLY, DECOMPRESSED AND PARSED WHILE THEY ARE DOWNLOADED"""
+def get_cell_data(country_code, token, chunksize=500000):
     
     links = get_opencell_url(country_code, token)
+    cells = get_download_manager().map(links, lambda response: read_cell_response(response, chunksize))
     
-    df_cell = pd.DataFrame()
-    for link in links:
-        response = requests.get(link, stream=True)
-        temp_file = wd + country_code.lower()+'.csv.gz.tmp'
-
-        totes_chunks = 0
-        with open(temp_file, 'wb') as feed_file:
-            for chunk in tqdm(response.iter_content(chunk_size=1024)):
-                if chunk:
-                    feed_file.write(chunk)
-                    totes_chunks += 1024
-        try:
-            with gzip.open(temp_file, 'rt') as feed_data:
-                df_cell = pd.concat([df_cell, pd.read_csv(feed_data)], ignore_index=True)
-        except IOError:
-            rate_limit = 'RATE_LIMITED'
-            bad_token = 'INVALID_TOKEN'
-            with open(temp_file, 'r') as eggs_erroneous:
-                contents = eggs_erroneous.readline()
-            if rate_limit in contents:
-                logging.error("Feed did not update. You're rate-limited!")
-            elif bad_token in contents:
-                logging.error("API token rejected by Unwired Labs!!")
-            else:
-                logging.error("Non-specific error.  Details in %s", temp_file)
-            raise
-    
+    # categories may differ between MCC files
+    df_cell = pd.concat(cells, ignore_index=True)
+    df_cell['radio'] = df_cell.radio.astype('category')
     return df_cell
 
 
 """OPENSTREETMAP SCHOOL LOCATIONS"""
 
-def osm_to_json(country_code):    
-    overpass_url = "http://overpass-api.de/api/interpreter"
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+
+
+"""ERROR REPORTED BY OVERPASS WITHIN A RESPONSE, E.G. QUERY TIMEOUT OR MEMORY LIMIT"""
+class OverpassError(Exception):
+    pass
+
+
+def osm_to_json(country_code, mode=configs.OSM_QUERY):
+    if mode == 'tiled':
+        return osm_tiles_to_json(country_code)
+
+    overpass_url = OVERPASS_URL
 
     overpass_query = f"""
     [out:json][timeout:600];
@@ -147,74 +184,146 @@ def osm_to_json(country_code):
     return response['elements']
 
 
-def get_osm_schools(country_code):
-    elements = osm_to_json(country_code)
+"""returns Overpass query of school nodes, ways and relations in the country, restricted to tile (south, west, north, east) if given"""
+def get_overpass_query(country_code, tile=None, timeout=configs.OSM_TIMEOUT):
+    bbox = '[bbox:{},{},{},{}]'.format(*tile) if tile is not None else ''
+    return f"""
+    [out:json][timeout:{timeout}]{bbox};
+    area["ISO3166-1"="{country_code.upper()[:2]}"]->.searchArea;
+    (
+      node[amenity=school](area.searchArea);
+      way[amenity=school](area.searchArea);
+      rel[amenity=school](area.searchArea);
+    );
+    out center;
+    """
+
+
+"""returns tiles (south, west, north, east) of size degrees covering the country boundary"""
+def get_osm_tiles(country_code, size=configs.OSM_TILE_SIZE):
+    country = get_country_geometry(country_code.upper())
+    minx, miny, maxx, maxy = country.bounds
+
+    tiles = []
+    for south in np.arange(miny, maxy, size):
+        for west in np.arange(minx, maxx, size):
+            tile = (round(float(south), 6), round(float(west), 6), round(float(min(south + size, maxy)), 6), round(float(min(west + size, maxx)), 6))
+            if country.prepared.intersects(box(tile[1], tile[0], tile[3], tile[2])):
+                tiles.append(tile)
+
+    return tiles
+
+
+"""returns four quarters of tile"""
+def split_tile(tile):
+    south, west, north, east = tile
+    lat, lon = round((south + north) / 2, 6), round((west + east) / 2, 6)
+    return [(south, west, lat, lon), (south, lon, lat, east), (lat, west, north, lon), (lat, lon, north, east)]
+
+
+"""returns elements of Overpass response, raises OverpassError if the query failed on the server"""
+def read_overpass_response(response):
+    result = response.json()
+    if 'error' in result.get('remark', '').lower():
+        raise OverpassError(result['remark'])
+    return result['elements']
+
+
+"""returns download manager of Overpass queries; concurrency and request rate follow the OSM configs"""
+@lru_cache(maxsize=None)
+def get_overpass_manager():
+    return DownloadManager(max_workers=configs.OSM_WORKERS, host_workers=configs.OSM_WORKERS, timeout=configs.OSM_TIMEOUT + 60, min_interval=configs.OSM_MIN_INTERVAL)
+
+
+"""returns elements of schools in tile; responses are cached as json under wd, None if the query fails"""
+def query_osm_tile(country_code, tile, wd):
+    path = wd + 'tile_{}_{}_{}_{}.json'.format(*tile)
+    elements = read_json(path)
+    if elements is not None:
+        return elements
+
+    url = OVERPASS_URL + '?' + urlencode({'data': get_overpass_query(country_code, tile)})
+    try:
+        elements = get_overpass_manager().fetch(url, read_overpass_response)
+    except (OverpassError, requests.RequestException, ValueError) as e:
+        print('Overpass query of tile ' + str(tile) + ' failed: ' + str(e))
+        return None
+
+    write_json(path, elements)
+    return elements
+
+
+"""returns elements of schools in the country; the country bounding box is split into tiles that are queried concurrently,
+tiles failing on the server are split into quarters up to max_splits times, elements of all tiles are merged"""
+def osm_tiles_to_json(country_code, size=configs.OSM_TILE_SIZE, max_splits=configs.OSM_MAX_SPLITS, wd=configs.WD + 'data/osm/'):
+    wd = wd + country_code.lower() + '/'
+    os.makedirs(wd, exist_ok=True)
+
+    tiles = get_osm_tiles(country_code, size)
+    elements = []
+    for split in range(max_splits + 1):
+        print('Querying ' + str(len(tiles)) + ' tiles from Overpass...')
+        with ThreadPoolExecutor(max_workers=configs.OSM_WORKERS) as executor:
+            results = list(tqdm(executor.map(lambda tile: query_osm_tile(country_code, tile, wd), tiles), total=len(tiles)))
+
+        elements += [i for result in results if result is not None for i in result]
+        tiles = [j for tile, result in zip(tiles, results) if result is None for j in split_tile(tile)]
+        if len(tiles) == 0:
+            return elements
+
+    raise RuntimeError('Unable to query schools from Overpass for ' + str(len(tiles)) + ' tiles!')
+
+
+"""OFFSETS OF WAY AND RELATION IDS IN source_school_id; OSM NUMBERS NODES, WAYS AND RELATIONS INDEPENDENTLY, SO IDS ARE ONLY UNIQUE PER TYPE"""
+OSM_ID_OFFSET = {'node': 0, 'way': 10**15, 'relation': 2 * 10**15}
+
+
+"""returns schools of Overpass elements as typed columns; nodes are located by their coordinates, ways and relations by their centres.
+elements are deduplicated by type and id, source_school_id holds the id offset by type and tags lists the element tags kept as columns"""
+def elements_to_df(elements, tags=None):
+    tags = list(tags or [])
     ids_already_seen = set()
-    tag = set()
-    features = []
-    geometry = None
+    ids, types, lats, lons = [], [], [], []
+    tag_values = {i: [] for i in tags}
+
     for elem in elements:
-        try:
-            if elem["id"] in ids_already_seen:
-                continue
-            ids_already_seen.add(elem["id"])
-        except KeyError:
-            print("Received corrupt data from Overpass (no id).")
+        elem_id = elem.get("id")
         elem_type = elem.get("type")
-        elem_tags = elem.get("tags")
-        elem_tags['osm_type'] = elem_type
-        for i in elem_tags.keys():
-            if i not in tag:
-                tag.add(i)
-        elem_nodes = elem.get("nodes", None)
-        elem_user = elem.get("user", None)
-        elem_uid = elem.get("uid", None)
-        elem_version = elem.get("version", None)
-        if elem_nodes:
-            elem_tags["nodes"] = elem_nodes
-        if elem_user:
-            elem_tags["user"] = elem_user
-        if elem_uid:
-            elem_tags["uid"] = elem_uid  
-        if elem_version:
-            elem_tags["version"] = elem_version  
-        if elem_type == "node":
-            # Create Point geometry
-            geometry = geojson.Point((elem.get("lon"), elem.get("lat")))
-            elem_tags['latitude']=elem.get("lat")
-            elem_tags['longitude']=elem.get("lon")
-        elif elem_type == "way" or elem_type == "relation":
-            # Create Way center geometry
-            geometry = geojson.Point((elem.get("center").get('lon'), elem.get("center").get('lat')))
-            elem_tags['latitude']=elem.get("center").get('lat')
-            elem_tags['longitude']=elem.get("center").get('lon')
-        else:
+        if elem_id is None or elem_type not in OSM_ID_OFFSET:
+            print("Received corrupt data from Overpass (no id or type).")
+            continue
+        if (elem_type, elem_id) in ids_already_seen:
+            continue
+
+        location = elem if elem_type == "node" else elem.get("center")
+        if location is None or location.get("lat") is None or location.get("lon") is None:
             print("Received corrupt data from Overpass (invalid element).")
+            continue
 
-        if geometry:
-            feature = geojson.Feature(
-                id=elem["id"],
-                geometry=geometry,
-                properties=elem_tags
-            )
-            features.append(feature)
-
-    data = geojson.FeatureCollection(features)
-    df_schools = pd.DataFrame(data.features)
-    len_df = len(df_schools)
-    for i in tag:
-        df_schools[i] = None
-    
-    print('Creating geodataframe of schools...')
-    for i in tqdm(range(len_df)):
-        school = df_schools.loc[i,]
-        for j,k in zip(school.properties.keys(), school.properties.values()):
-            try:
-                df_schools.loc[i,j]=k
-            except:
-                break
-        df_schools.loc[i,'geometry'] = Point(df_schools.loc[i,'geometry'].coordinates)
-    df_schools.drop(columns='properties', inplace=True)
-    df_schools.rename(columns={'id': 'source_school_id'}, inplace=True)
-
-    return df_schools[['source_school_id', 'latitude', 'longitude']]
+        ids_already_seen.add((elem_type, elem_id))
+        ids.append(OSM_ID_OFFSET[elem_type] + elem_id)
+        types.append(elem_type)
+        lats.append(location["lat"])
+        lons.append(location["lon"])
+
+        elem_tags = elem.get("tags") or {}
+        for i in tags:
+            tag_values[i].append(elem_tags.get(i))
+
+    df_schools = pd.DataFrame({
+        'source_school_id': np.array(ids, dtype='int64'),
+        'osm_type': pd.Categorical(types, categories=list(OSM_ID_OFFSET)),
+        'latitude': np.array(lats, dtype='float64'),
+        'longitude': np.array(lons, dtype='float64'),
+    })
+    for i in tags:
+        df_schools[i] = pd.Series(tag_values[i], dtype='object')
+
+    return df_schools
+
+
+def get_osm_schools(country_code, tags=None):
+    elements = osm_to_json(country_code)
+
+    print('Creating dataframe of schools...')
+    return elements_to_df(elements, tags)
@@ -1,61 +1,342 @@
 
 """LOAD DEPENDENCIES"""
+import os
+import re
+import hashlib
 import sys
+import time
+import zipfile
 import numpy as np
+import pandas as pd
 from shapely.geometry import Point
 import geopandas as gp
 from shapely import wkt
 
+from data_gathering.opendata_raster import iter_raster_blocks
+from feature_engineering import configs
 
-"""tif_to_gdf to get data from tif file as geopandas df"""
-def tif_to_gdf(tif):
+
+"""tif_to_gdf to get data from tif file as geopandas df; compact mode drops nodata and zero cells before geometries are created,
+with geometry=False coordinates are returned as float32 longitude/latitude columns and points can be created later with xy_to_gdf"""
+def tif_to_gdf(tif, compact=False, geometry=True, block_size=None):
     print('Getting values from tif file...')
-    try:
-        srcband = tif.GetRasterBand(1).ReadAsArray()
-    except RuntimeError as e:
-        print('Band 1 not found')
-        print(e)
-        sys.exit(1)
-    
-    flat = srcband.flatten()
-    flat = np.where(flat == -99999, 0, flat)
-    
     gt = tif.GetGeoTransform()
-    
-    res = gt[1]
-    
-    xmin = gt[0]
-    ymax = gt[3]
-    
-    xsize = tif.RasterXSize
-    ysize = tif.RasterYSize
-    
-    xstart = xmin + res/2
-    ystart = ymax - res/2
-    
-    x = np.arange(xstart, xstart + xsize*res, res)
-    y = np.arange(ystart, ystart - ysize*res, -res)
-
-    if len(x) != xsize:
-        x = x[:-1]
-    
-    if len(y) != ysize:
-        y = y[:-1]
-    
-    x = np.tile(x, ysize)
-    y = np.repeat(y, xsize)
-    
-    print('Creating geometries; this might take a few minutes...')
-    geometry = [Point(ij) for ij in zip(x,y)]
-    
-    tif_dict = {'population': flat, 'geometry': geometry}
-    print('Creating geo dataframe; this might take a few minutes...')
-    return gp.GeoDataFrame(tif_dict, crs='EPSG:4326')
-
-
-"""df_to_gdf to convert pandas df to geopandas df"""
-def df_to_gdf(df):
-    df['geometry'] = df['geometry'].apply(wkt.loads)
+
+    if compact:
+        values, x, y = [], [], []
+        try:
+            for (col_off, row_off, col_end, row_end), block in iter_raster_blocks(tif, block_size):
+                rows, cols = np.nonzero(block)
+                values.append(block[rows, cols].astype('float32'))
+                x.append((gt[0] + (cols + col_off + 0.5) * gt[1]).astype('float32'))
+                y.append((gt[3] + (rows + row_off + 0.5) * gt[5]).astype('float32'))
+        except RuntimeError as e:
+            print('Band 1 not found')
+            print(e)
+            sys.exit(1)
+
+        flat = np.concatenate(values) if values else np.array([], dtype='float32')
+        x = np.concatenate(x) if x else np.array([], dtype='float32')
+        y = np.concatenate(y) if y else np.array([], dtype='float32')
+
+    else:
+        try:
+            srcband = tif.GetRasterBand(1).ReadAsArray()
+        except RuntimeError as e:
+            print('Band 1 not found')
+            print(e)
+            sys.exit(1)
+
+        flat = srcband.flatten()
+        flat = np.where(flat == -99999, 0, flat)
+
+        x = gt[0] + (np.arange(tif.RasterXSize) + 0.5) * gt[1]
+        y = gt[3] + (np.arange(tif.RasterYSize) + 0.5) * gt[5]
+
+        x = np.tile(x, tif.RasterYSize)
+        y = np.repeat(y, tif.RasterXSize)
+
+    df = pd.DataFrame({'population': flat, 'longitude': x, 'latitude': y})
+    if not geometry:
+        return df
+
+    return xy_to_gdf(df)
+
+
+"""xy_to_gdf to create point geometries from longitude/latitude columns"""
+def xy_to_gdf(df):
+    print('Creating geometries...')
+    geometry = gp.points_from_xy(df['longitude'], df['latitude'])
+    return gp.GeoDataFrame(df.drop(columns=['longitude', 'latitude']), geometry=geometry, crs='EPSG:4326')
+
+
+"""read_file_batches to stream a vector file (local path, zip archive or url) as geopandas dfs of batch_size features;
+only features intersecting bbox are read and only the given property columns are kept"""
+def read_file_batches(path, bbox=None, columns=None, batch_size=100000):
+    import fiona
+
+    if path.endswith('.zip') and '://' in path:
+        path = 'zip+' + path
+    elif path.endswith('.zip'):
+        # shapefile may be in a folder within the archive
+        with zipfile.ZipFile(path) as z:
+            shp = [i for i in z.namelist() if i.endswith('.shp')]
+        path = 'zip://' + path + ('!' + shp[0] if shp else '')
+
+    with fiona.open(path) as src:
+        crs = src.crs_wkt
+        features = src.filter(bbox=tuple(bbox)) if bbox is not None else iter(src)
+
+        batch = []
+        for feature in features:
+            properties = dict(feature['properties'])
+            if columns is not None:
+                properties = {i: properties[i] for i in columns}
+            batch.append({'type': 'Feature', 'geometry': feature['geometry'], 'properties': properties})
+
+            if len(batch) == batch_size:
+                yield gp.GeoDataFrame.from_features(batch, crs=crs)
+                batch = []
+
+        if batch:
+            yield gp.GeoDataFrame.from_features(batch, crs=crs)
+
+
+"""df_to_gdf to convert pandas df (or csv file path) to geopandas df; geometry columns are decoded array-wise from WKT or WKB (hex) strings.
+usecols and dtype restrict and type the columns that are materialised"""
+def df_to_gdf(df, usecols=None, dtype=None):
+    if isinstance(df, str):
+        df = pd.read_csv(df, usecols=usecols, dtype=dtype)
+    else:
+        if usecols is not None:
+            df = df[list(usecols)]
+        if dtype is not None:
+            df = df.astype(dtype)
+
+    df['geometry'] = decode_geometry(df['geometry'])
     if 'school_location' in df.columns:
-        df['school_location'] = df['school_location'].apply(wkt.loads)
-    return gp.GeoDataFrame(df, crs='EPSG:4326')
\ No newline at end of file
+        df['school_location'] = decode_geometry(df['school_location'])
+    return gp.GeoDataFrame(df, crs='EPSG:4326')
+
+
+"""decode_geometry to parse a column of WKT, WKB or WKB hex strings into geometries at once"""
+def decode_geometry(values):
+    if isinstance(values.dtype, gp.array.GeometryDtype):
+        return values
+
+    values = values.where(values.notna(), None)
+    sample = values.dropna()
+    sample = sample.iloc[0] if len(sample) else None
+
+    if isinstance(sample, bytes) or (isinstance(sample, str) and re.fullmatch('[0-9A-Fa-f]+', sample)):
+        return gp.GeoSeries.from_wkb(values.values, index=values.index)
+    if isinstance(sample, str) or sample is None:
+        return gp.GeoSeries.from_wkt(values.values, index=values.index)
+    return gp.GeoSeries(values)
+
+
+"""CACHE LAYER"""
+
+"""returns geoparquet path of csv cache path"""
+def get_parquet_path(path):
+    for ext in ['.csv.gz', '.csv']:
+        if path.endswith(ext):
+            return path[:-len(ext)] + '.parquet'
+    return path + '.parquet'
+
+
+"""returns short hash of the config values a cached dataset is built with; cache file names carry it so changed configs are not served stale caches"""
+def get_config_key(*values):
+    return hashlib.sha256(repr(values).encode()).hexdigest()[:10]
+
+
+"""returns csv cache names of the school joined population, facebook and satellite datasets"""
+def get_pop_cache_name(country_code, year, join, coverage, buffer):
+    return 'school_agg_pop_' + country_code.lower() + '_' + get_config_key(year, join, coverage, buffer) + '.csv'
+
+
+def get_facebook_cache_name(country_code, n_schools, radius):
+    return 'facebook_' + country_code.lower() + '_' + str(n_schools) + '_' + get_config_key(radius) + '.csv'
+
+
+def get_satellite_cache_name(country_code, collections, start_year, end_year, buffer, scale):
+    return 'satellite_' + country_code.lower() + '_' + get_config_key(collections, start_year, end_year, buffer, scale) + '.csv'
+
+
+"""CONFIGURATIONS OF THE CACHES NAMED WITHOUT CONFIGURATION KEY; such caches of earlier versions are renamed to their keyed names
+when the configuration matches, so paid facebook and earth engine calls are not repeated"""
+LEGACY_POP_CONFIG = (2020, 'center', 1)
+LEGACY_FACEBOOK_CONFIG = (5,)
+LEGACY_SATELLITE_CONFIG = ({'CSP/HM/GlobalHumanModification': None, 'NOAA/VIIRS/DNB/MONTHLY_V1/VCMSLCFG': ['avg_rad', 'cf_cvg'], 'MODIS/006/MOD13A2': ['NDVI']}, 2014, 2019, 5, 30)
+
+
+"""returns csv cache names the school joined datasets had before configuration keys, None if the configuration differs from the legacy one"""
+def get_legacy_pop_cache_name(country_code, year, join, coverage, buffer):
+    if join != 'integral' and (year, coverage, buffer) == LEGACY_POP_CONFIG:
+        return 'school_agg_pop_' + country_code.lower() + '.csv'
+
+
+def get_legacy_facebook_cache_name(country_code, n_schools, radius):
+    if (radius,) == LEGACY_FACEBOOK_CONFIG:
+        return 'facebook_' + country_code.lower() + '_' + str(n_schools) + '.csv'
+
+
+def get_legacy_satellite_cache_name(country_code, collections, start_year, end_year, buffer, scale):
+    if (collections, start_year, end_year, buffer, scale) == LEGACY_SATELLITE_CONFIG:
+        return 'satellite_' + country_code.lower() + '.csv'
+
+
+"""renames legacy cache (csv and geoparquet) in wd to file_name unless the dataset is already cached under file_name"""
+def migrate_legacy_cache(wd, file_name, legacy_name):
+    if legacy_name is None or cache_exists(wd + file_name):
+        return
+
+    for source, target in [(wd + legacy_name, wd + file_name), (get_parquet_path(wd + legacy_name), get_parquet_path(wd + file_name))]:
+        if os.path.exists(source):
+            print('Renaming ' + os.path.basename(source) + ' to ' + os.path.basename(target) + '...')
+            os.replace(source, target)
+
+
+"""returns True if dataset is cached either as geoparquet or csv"""
+def cache_exists(path):
+    return os.path.exists(get_parquet_path(path)) or os.path.exists(path)
+
+
+"""reads cached dataset given its csv path; geoparquet is preferred over csv, datasets with geometry are returned as geopandas df.
+usecols restricts the columns read; complete csv caches are converted to geoparquet on first read if cache_format is parquet"""
+def read_cache(path, usecols=None, dtype=None, cache_format=configs.CACHE_FORMAT):
+    parquet_path = get_parquet_path(path)
+    if os.path.exists(parquet_path):
+        df = read_parquet(parquet_path, usecols)
+        return df.astype(dtype) if dtype is not None else df
+
+    df = pd.read_csv(path, usecols=usecols, dtype=dtype)
+    if 'geometry' in df.columns:
+        df = df_to_gdf(df[df.geometry.notna()].copy())
+
+    if cache_format == 'parquet' and usecols is None:
+        write_parquet(df, parquet_path)
+    return df
+
+
+"""writes dataset to cache given its csv path; csv is written as well if cache_format is csv or export_csv is set"""
+def write_cache(df, path, cache_format=configs.CACHE_FORMAT, export_csv=configs.CACHE_EXPORT_CSV):
+    if cache_format == 'parquet':
+        write_parquet(df, get_parquet_path(path))
+    if cache_format == 'csv' or export_csv:
+        df.to_csv(path, index=False)
+
+
+"""writes df as zstd compressed geoparquet with wkb geometry, df without geometry column as plain parquet"""
+def write_parquet(df, path):
+    if 'geometry' in df.columns:
+        df = gp.GeoDataFrame(df, geometry='geometry', crs=df.crs if isinstance(df, gp.GeoDataFrame) and df.crs is not None else 'EPSG:4326')
+        if 'school_location' in df.columns:
+            df['school_location'] = gp.GeoSeries(df['school_location'], crs=df.crs)
+
+    df.to_parquet(path + '.tmp', compression='zstd', index=False)
+    os.replace(path + '.tmp', path)
+
+
+"""reads geoparquet as geopandas df, plain parquet as pandas df"""
+def read_parquet(path, usecols=None):
+    import pyarrow.parquet as pq
+    metadata = pq.read_schema(path).metadata or {}
+    if b'geo' in metadata and (usecols is None or 'geometry' in usecols):
+        return gp.read_parquet(path, columns=usecols)
+    return pd.read_parquet(path, columns=usecols)
+
+
+"""GEOMETRY SIMPLIFICATION"""
+
+"""returns whether polygons form a coverage: the areas do not overlap each other, gaps between them are allowed"""
+def is_coverage(geometries):
+    from shapely.ops import unary_union
+    geometries = [i for i in geometries if i is not None and not i.is_empty]
+    if not all(i.geom_type in ('Polygon', 'MultiPolygon') for i in geometries):
+        return False
+
+    area = sum(i.area for i in geometries)
+    return abs(area - unary_union(geometries).area) <= 1e-6 * area
+
+
+"""returns polygons of a coverage simplified edge by edge; boundaries are split into edges between the points where three or more
+areas meet, each edge is simplified once and the faces formed by the simplified edges are given to the area they overlap most, so
+neighbouring areas keep sharing their edges. works with any shapely version, areas that collapse keep their original geometry"""
+def simplify_coverage_edges(geometries, tolerance):
+    from shapely.ops import unary_union, linemerge, polygonize
+    geometries = gp.GeoSeries(geometries.values, crs=geometries.crs)
+
+    edges = linemerge(unary_union([i.boundary for i in geometries if i is not None and not i.is_empty]))
+    edges = unary_union([i.simplify(tolerance, preserve_topology=True) for i in getattr(edges, 'geoms', [edges])])
+    faces = gp.GeoDataFrame(geometry=list(polygonize(getattr(edges, 'geoms', [edges]))), crs=geometries.crs)
+
+    pairs = gp.sjoin(faces, gp.GeoDataFrame(geometry=geometries), how='inner', op='intersects')
+    # only the largest overlap of each face matters, so areas are compared in degrees
+    pairs['overlap'] = gp.GeoSeries(list(pairs.geometry.values)).intersection(
+        gp.GeoSeries(list(geometries.values[pairs.index_right.values]))).area.values
+    # faces outside every area (gaps and holes) touch areas only along their edges
+    pairs = pairs[pairs.overlap > 0].reset_index().sort_values('overlap').drop_duplicates('index', keep='last')
+
+    simplified = list(geometries.values)
+    for area, group in pairs.groupby('index_right'):
+        simplified[area] = unary_union(list(group.geometry.values))
+    return simplified
+
+
+"""returns polygons of a coverage simplified to tolerance so edges shared by neighbouring areas stay aligned and no gaps or overlaps
+open between them; shapely >= 2.1 coverage simplification is used for valid coverages, other coverages are simplified edge by edge"""
+def simplify_geometries(geometries, tolerance):
+    import shapely
+    geometries = gp.GeoSeries(geometries)
+
+    values = np.asarray(geometries.values)
+    if hasattr(shapely, 'coverage_simplify') and shapely.coverage_is_valid(values):
+        return gp.GeoSeries(shapely.coverage_simplify(values, tolerance), index=geometries.index, crs=geometries.crs)
+    return gp.GeoSeries(simplify_coverage_edges(geometries, tolerance), index=geometries.index, crs=geometries.crs)
+
+
+"""prints geometry size and time of a sample school buffer join of layer before and after simplification"""
+def report_simplification(original, simplified, sample_size=10000):
+    sizes = [sum(len(i.wkb) for i in layer.geometry if i is not None) / 1024**2 for layer in (original, simplified)]
+
+    minx, miny, maxx, maxy = original.total_bounds
+    rng = np.random.default_rng(0)
+    points = gp.points_from_xy(rng.uniform(minx, maxx, sample_size), rng.uniform(miny, maxy, sample_size))
+    buffers = gp.GeoDataFrame(geometry=gp.GeoSeries(points).buffer(configs.SCHOOL_BUFFER / 100).values, crs=original.crs)
+
+    times = []
+    for layer in (original, simplified):
+        start = time.perf_counter()
+        gp.sjoin(buffers, layer[['geometry']], how='inner', op='intersects')
+        times.append(time.perf_counter() - start)
+
+    print('Geometry size {:.1f} MB -> {:.1f} MB ({:.0%} smaller), sample join {:.2f}s -> {:.2f}s ({:.1f}x faster)'.format(
+        sizes[0], sizes[1], 1 - sizes[1] / max(sizes[0], 1e-9), times[0], times[1], times[0] / max(times[1], 1e-9)))
+
+
+"""returns layer with geometries simplified to tolerance; the simplified layer is cached next to the layer at path (csv, parquet or json)
+and rebuilt when the layer is newer. None tolerance returns the layer unchanged, as do layers whose areas overlap each other since
+simplifying them would open gaps and overlaps between neighbouring areas"""
+def get_simplified(gdf, path, tolerance=configs.SIMPLIFY_TOLERANCE):
+    if not tolerance:
+        return gdf
+
+    simplified_path = re.sub(r'(\.csv\.gz|\.csv|\.parquet|\.json|\.geojson)$', '', path) + '_simplified_' + str(tolerance) + '.csv'
+    sources = [i for i in [path, get_parquet_path(path)] if os.path.exists(i)]
+    cached = [i for i in [get_parquet_path(simplified_path), simplified_path] if os.path.exists(i)]
+
+    if cached and os.path.getmtime(cached[0]) >= max([os.path.getmtime(i) for i in sources], default=0):
+        return read_cache(simplified_path)
+
+    if not is_coverage(gdf.geometry):
+        print('Areas of ' + os.path.basename(path) + ' overlap each other, geometries are not simplified.')
+        return gdf
+
+    print('Simplifying geometries of ' + os.path.basename(path) + '...')
+    simplified = gp.GeoDataFrame(gdf.copy(), geometry='geometry', crs=gdf.crs if gdf.crs is not None else 'EPSG:4326')
+    simplified['geometry'] = simplify_geometries(simplified.geometry, tolerance).values
+    report_simplification(simplified.set_geometry(gdf.geometry.values), simplified)
+
+    write_cache(simplified, simplified_path)
+    return simplified
@@ -1,4 +1,7 @@
 
 
 from . import configs
+from . import tree_cache
+from . import quadkey_index
+from . import manifest
 from . import data_pipeline
\ No newline at end of file
@@ -4,7 +4,18 @@ COUNTRY_CODE = 'phl'
 AVAILABLE_COUNTRIES = ['bra', 'tha', 'phl'] # list of country names 
 FEATURES = ['satellite', 'facebook', 'opencell', 'population', 'speedtest']  # one or multiple of'population', 'facebook', 'opencell', 'satellite', 'speedtest'
 SCHOOL_BUFFER = 1  # in kilometers
+FEATURE_N_JOBS = 1 # number of features loaded and joined concurrently, 1 for sequential, -1 or 0 for all cores
+FEATURE_POOL = 'thread' # 'thread' or 'process'
+FEATURE_INCREMENTAL = False # rebuild only features whose source files, configs or school set changed since the last run
 SURVEY_AREAS = ''
+SURVEY_NEAREST_RADIUS = 0.05 # in degrees, initial search radius for schools outside every survey area in 'tiles' mode
+SIMPLIFY_TOLERANCE = None # in degrees, tolerance survey areas and country boundaries are simplified to, None to keep full detail
+SURVEY_BATCH_SIZE = 100000 # number of survey microdata records decoded at once
+CACHE_FORMAT = 'parquet' # 'parquet' (geoparquet, zstd compressed) or 'csv' for intermediate datasets
+CACHE_EXPORT_CSV = False # write csv copies next to parquet caches
+KDTREE_N_JOBS = 1 # number of threads for batch KD tree queries, -1 for all cores
+KDTREE_LEAF_SIZE = 2
+KDTREE_CACHE_SIZE = 2048 # in megabytes, least recently used trees are evicted above this size
 SATELITTE_COLLECTIONS = {'CSP/HM/GlobalHumanModification': None, 'NOAA/VIIRS/DNB/MONTHLY_V1/VCMSLCFG': ['avg_rad', 'cf_cvg'], 'MODIS/006/MOD13A2': ['NDVI']}
 SATELITTE_START_YEAR = 2014 # should be at least 2014
 SATELITTE_END_YEAR = 2019 # 2021 might be exist for some collections..
@@ -13,7 +24,20 @@ SATELITTE_MAX_CALL_SIZE = 5000 # default max call size
 SATELITTE_IMAGE_SCALE = 30
 GOOGLE_SERVICES_ACCOUNT = 'xxxxxx@xxxxxxxx.iam.gserviceaccount.com'
 GOOGLE_EARTH_ENGINE_API_JSON_KEY = 'xxxxxxx-xxxxxxxx.json'
+DOWNLOAD_WORKERS = 8 # number of files of multi-file sources downloaded concurrently
+DOWNLOAD_HOST_WORKERS = 4 # number of concurrent downloads from one host
+DOWNLOAD_RETRIES = 5 # retries of failed downloads, waiting DOWNLOAD_BACKOFF * 2 ** attempt seconds in between
+DOWNLOAD_BACKOFF = 1 # in seconds
+DOWNLOAD_TIMEOUT = 60 # in seconds, connect and read timeout of downloads
+DOWNLOAD_REVALIDATE = True # if True, downloaded raw files are checked for updates with conditional requests before they are reused
 OPENCELLID_ACCESS_TOKEN = '' # 2 calls per day
+OPENCELL_CHUNK_SIZE = 500000 # number of rows of OpenCelliD files parsed at once while downloading
+OSM_QUERY = 'tiled' # 'tiled' to query schools tile by tile, 'country' for one country-wide query of school nodes
+OSM_TILE_SIZE = 2 # in degrees, size of the tiles the country bounding box is split into
+OSM_WORKERS = 2 # number of concurrent Overpass queries
+OSM_MIN_INTERVAL = 1 # in seconds, minimum interval between the starts of Overpass queries
+OSM_TIMEOUT = 180 # in seconds, Overpass timeout of a tile query
+OSM_MAX_SPLITS = 3 # number of times failing tiles are split into quarters and queried again
 FACEBOOK_MARKETING_API_ACCESS_TOKEN = ''
 FACEBOOK_AD_ACCOUNT_ID = ''
 FACEBOOK_CALL_LIMIT = 300 # default fb ad_services call size
@@ -22,4 +46,14 @@ FACEBOOK_SCHOOL_DATA_LEN = {'bra': 11732, 'tha': 4723, 'phl': 4599}
 SPEEDTEST_TILE_TYPE = 'mobile' # can be 'fixed' or 'mobile'
 SPEEDTEST_TILE_YEAR = 2021 # data is available quarterly and usually approximately 1 month after quarter ends 
 SPEEDTEST_TILE_QUARTER = 2 # 1-4 integer
-POPULATION_DATASET_YEAR = 2020 # dataset currently available for years 2000-2020
\ No newline at end of file
+CLIP_TOLERANCE = 0.01 # in degrees, features this far inside the country boundary are clipped without exact test
+SPEEDTEST_BATCH_SIZE = 100000 # number of tiles read at once from the global tile file
+SPEEDTEST_JOIN = 'quadkey' # 'quadkey' to look up the tile of each school by quadkey, 'kdtree' to join the nearest tile centroid
+SPEEDTEST_TILE_ZOOM = 16 # zoom level of the speedtest tile quadkeys
+SPEEDTEST_MAX_RING = 2 # rings of neighbouring tiles searched if the school tile is missing
+SPEEDTEST_AGGREGATE_RING = None # None to take the school tile, otherwise number of rings of tiles averaged weighted by test counts
+POPULATION_DATASET_YEAR = 2020 # dataset currently available for years 2000-2020
+RASTER_BLOCK_SIZE = 512 # in pixels, rasters are streamed in blocks of this size; None for native GDAL block size
+POPULATION_JOIN = 'zonal' # 'zonal' sums raster windows of school buffers, 'integral' queries summed area table saved next to the tif file
+POPULATION_COMPACT = True # drop nodata and zero population cells when converting raster to points
+POPULATION_COVERAGE = 'center' # 'center' sums pixels with centre in school buffer, 'fractional' weights pixels by covered share
\ No newline at end of file
@@ -4,14 +4,18 @@ import pandas as pd
 import geopandas as gp
 import numpy as np
 from tqdm import tqdm
-import pickle
 import os, stat
+import re
+import warnings
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from sklearn.preprocessing import OneHotEncoder
-from sklearn.neighbors import KDTree
 
 
 """LOAD MODULES"""
 from feature_engineering import configs
+from feature_engineering.tree_cache import TreeCache
+from feature_engineering.quadkey_index import QuadkeyIndex, lonlat_to_tile, quadkey_to_tile
+from feature_engineering.manifest import FeatureManifest
 from survey import *
 from data_gathering.opendata import *
 
@@ -25,13 +29,13 @@ class FeatureEngineering():
         self.country_code = configs.COUNTRY_CODE.lower()
         self.country = configs.COUNTRY.title()
         self.features = configs.FEATURES
+        self.tree_cache = TreeCache(self.data_dir + 'interim/kdtree/')
 
 
         """SET SURVEY SCHOOL DATA"""
-        if os.path.exists(self.data_dir + 'school_loc/school_data_' + self.country_code + '.csv'):
+        if cache_exists(self.data_dir + 'school_loc/school_data_' + self.country_code + '.csv'):
             print('Reading school data...')
-            self.school_data = pd.read_csv(self.data_dir + 'school_loc/school_data_' + self.country_code + '.csv')
-            self.school_data = df_to_gdf(self.school_data)
+            self.school_data = read_cache(self.data_dir + 'school_loc/school_data_' + self.country_code + '.csv')
         else:
             self.school_data = School(self.country_code).data
             self.survey = Survey(self.country_code).data
@@ -39,9 +43,9 @@ class FeatureEngineering():
             if configs.SURVEY_AREAS == 'enumeration':
                 self.school_data = self.join_survey_schools()
             elif configs.SURVEY_AREAS == 'tiles':
-                self.school_data = self.join_by_kdtree(self.survey, ['target'])
+                self.school_data = self.join_survey_tiles()
             
-            self.school_data.to_csv(self.data_dir + 'school_loc/school_data_' + self.country_code + '.csv', index= False)
+            write_cache(self.school_data, self.data_dir + 'school_loc/school_data_' + self.country_code + '.csv')
         
         print('School dataset is initialized, length of the dataset is ' + str(len(self.school_data)) + '!')
 
@@ -53,7 +57,7 @@ class FeatureEngineering():
                  num, cat - numerical and categorical variables
                  sub_features - list of sub-features
         """
-        if feature in ['satellite', 'facebook']:
+        if feature in ['satellite', 'facebook', 'population']:
             df = eval(feature.title() + 'Data("' + self.country_code + '", locations=self.school_data)').data
         else:
             df = eval(feature.title() + 'Data("' + self.country_code + '")').data
@@ -106,44 +110,74 @@ class FeatureEngineering():
     def map_feature(self, feature):
         """
         Join schools to feature via the features geometry
-        :param df: dataframe containing features to be added
-        :param school_data: dataframe containing school data
-        :param sub_features: list of sub-features
+        :param feature: feature name
         :return: school_data - school dataframe with new features added
         """
-        
+        columns, by_id = self.get_feature_columns(feature)
+        self.join_feature_columns(columns, by_id)
+        print(feature.title() + ' features added to the dataset!')
+
+
+    def get_feature_columns(self, feature):
+        """
+        Load feature and map it to schools without changing the school dataset
+        :param feature: feature name
+        :return: columns - dataframe of new feature columns keyed by source_school_id
+                 by_id - True if the feature is joined to schools by source school id
+        """
         df, sub_features = self.load_feature(feature.lower())
-        
-        if feature.lower() == 'population':
-            df = self.join_population(df)
 
         if 'source_school_id' in df:
-            self.join_by_id(df)
-            print(feature.title() + ' features added to the dataset!')
+            return df, True
+        elif feature.lower() == 'speedtest' and configs.SPEEDTEST_JOIN == 'quadkey':
+            return self.get_quadkey_columns(df, sub_features), False
         else:
-            self.join_by_kdtree(df, sub_features)
-            print(feature.title() + ' features added to the dataset!')
+            return self.get_kdtree_columns(df, sub_features), False
 
 
-    def get_centroids(self, df):
+    def join_feature_columns(self, columns, by_id):
+        """
+        Add feature columns keyed by source_school_id to the school dataset
+        :param columns: dataframe of feature columns keyed by source_school_id
+        :param by_id: True to merge as feature joined by source school id, False to set columns of location joined feature
+        """
+        if by_id:
+            self.join_by_id(columns)
+        elif np.array_equal(columns.source_school_id.to_numpy(), self.school_data.source_school_id.to_numpy()):
+            # columns are built in school order, joining by position keeps values of schools sharing an id apart
+            for feature in columns.columns.drop('source_school_id'):
+                self.school_data[feature] = columns[feature].values
+        elif columns.source_school_id.is_unique:
+            columns = columns.set_index('source_school_id')
+            for feature in columns:
+                self.school_data[feature] = self.school_data.source_school_id.map(columns[feature]).values
+        else:
+            raise ValueError('Feature columns are not in school order and source school ids are not unique!')
 
+
+    def get_centroids(self, df):
+        """
+        Get feature locations as coordinate array
+        :param df: dataframe of feature with geometry, lon/lat or longitude/latitude columns
+        :return: centroids - contiguous float64 array of shape (n, 2) holding x and y coordinates
+        """
         if 'geometry' in df:
-            # get centroids from polygon and point geometries
+            # get centroids from mixed polygon, multipolygon and point geometries
             print('Getting centroids...')
-            if (df['geometry'][0].geom_type == 'Polygon') or (df['geometry'][0].geom_type == 'MultiPolygon'):
-                try:
-                    centroids = [i.centroid for i in df['geometry']]
-                except RuntimeError:
-                    print('Failed to get polygon centroids.')
-                centroids = [[i.x, i.y] for i in centroids]
-            elif df['geometry'][0].geom_type == 'Point':
-                centroids = [[i.x, i.y] for i in df['geometry']]
+            try:
+                with warnings.catch_warnings():
+                    # centroids of small tiles and buffers are precise enough in geographic crs
+                    warnings.simplefilter('ignore', UserWarning)
+                    centroids = gp.GeoSeries(df['geometry']).centroid
+            except RuntimeError:
+                print('Failed to get polygon centroids.')
+            xy = [centroids.x, centroids.y]
         elif 'lon' in df:
-            centroids = [[x, y] for x, y in zip(df['lon'], df['lat'])]
+            xy = [df['lon'], df['lat']]
         elif 'longitude' in df:
-            centroids = [[x, y] for x, y in zip(df['longitude'], df['latitude'])]
+            xy = [df['longitude'], df['latitude']]
 
-        return centroids
+        return np.ascontiguousarray(np.column_stack(xy), dtype='float64')
 
     
     def join_by_id(self, df):
@@ -160,18 +194,34 @@ class FeatureEngineering():
     # construct kdtree of feature locations
     def build_tree(self, centroids):
         """
-        Construct KD tree of locations to be queried by school locations
+        Construct KD tree of locations to be queried by school locations; trees are read from the cache if the same locations were indexed before
         :param centroids: locations corresponding to feature values
         :return: tree
         """
-        print('Constructing KD tree..')
-        tree = KDTree(centroids, leaf_size=2)
-        with open(r"kdtreeOfCentroidsOfTiles.pickle", "wb") as output_file:
-            pickle.dump(tree, output_file)
+        return self.tree_cache.get_tree(centroids)
 
-        return tree
+    def query_tree(self, tree, locations, n_jobs=configs.KDTREE_N_JOBS):
+        """
+        Query KD tree with all school locations in one batch
+        :param tree: KD tree of feature locations
+        :param locations: (n, 2) array of school longitudes and latitudes
+        :param n_jobs: number of threads the batch is split across, -1 for all cores
+        :return: dist, ind - distance to and position of the nearest feature location for every school
+        """
+        if n_jobs == -1:
+            n_jobs = os.cpu_count()
 
-    def join_by_kdtree(self, df, sub_features):
+        if n_jobs is None or n_jobs <= 1 or len(locations) < 2 * n_jobs:
+            dist, ind = tree.query(locations, k=1)
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                results = list(executor.map(lambda chunk: tree.query(chunk, k=1), np.array_split(locations, n_jobs)))
+            dist = np.concatenate([r[0] for r in results])
+            ind = np.concatenate([r[1] for r in results])
+
+        return dist[:, 0], ind[:, 0]
+
+    def get_kdtree_columns(self, df, sub_features):
             print('Mapping features to schools by KDtree...')
 
             centroids = self.get_centroids(df)
@@ -181,46 +231,68 @@ class FeatureEngineering():
             except RuntimeError:
                 print('Could not construct location tree. "centroids" must be erroneous.')
 
-            for feature in sub_features:
-                self.school_data[feature] = np.zeros(len(self.school_data.source_school_id))
-
             print('Mapping closest tree nodes to the schools...')
-            for row in tqdm(self.school_data.itertuples()):
+            school_location_xy = self.school_data[['longitude', 'latitude']].to_numpy(dtype='float64')
+            # query feature location tree with all school locations to match nearest neighbours
+            try:
+                dist, ind = self.query_tree(tree, school_location_xy)
+            except RuntimeError:
+                print('Failed to query location tree.')
 
-                school_location_xy = [row.longitude, row.latitude]
-                # query feature location tree with school location to match nearest neighbours
-                try:
-                    dist, ind = tree.query(np.array([school_location_xy]), k=1)
-                except RuntimeError:
-                    print('Failed to query location tree.')
+            columns = pd.DataFrame({'source_school_id': self.school_data.source_school_id.values})
+            for feature in sub_features:
+                # get feature values at the positions from tree query (i.e. feature values at nearest locations to schools)
+                values = df[feature].to_numpy()[ind]
 
-                # set corresponding value of feature at this row in the school dataframe
-                for feature in sub_features:
-                    # get feature value at the index from tree query (i.e. feature value at nearest location to school)
-                    value = df.loc[df.index == ind[0, 0]][feature][ind[0, 0]]
+                # for range features, set 1 for schools being within range
+                if feature == 'range':
+                    values = np.where(values >= dist, 1, values)
 
-                    # for range features, set True for school being within range and False for out of range
-                    if feature == 'range':
-                        if value >= dist:
-                            value = 1
+                columns[feature] = values
 
-                    self.school_data.at[row[0], feature] = value
+            return columns
 
+    def get_quadkey_columns(self, df, sub_features, max_ring=configs.SPEEDTEST_MAX_RING, aggregate_ring=configs.SPEEDTEST_AGGREGATE_RING):
+        """
+        Map tile features to schools by looking up the quadkey tile of each school in a hash index
+        :param df: dataframe of tiles with quadkey or geometry and optional tests column
+        :param sub_features: list of sub-features
+        :param max_ring: number of rings of neighbouring tiles searched if the school tile is missing
+        :param aggregate_ring: None to take the school tile, otherwise number of rings of tiles averaged weighted by test counts
+        :return: columns - dataframe of new feature columns keyed by source_school_id
+        """
+        print('Mapping features to schools by quadkey...')
 
-    def join_population(self, df):
-        """JOIN POPULATION"""
-        if df is None:
-            print('Reading joined population data...')
-            df = pd.read_csv(self.data_dir + 'worldpop/school_agg_pop_' + self.country_code + '.csv')
+        if 'quadkey' in df:
+            x, y = quadkey_to_tile(df['quadkey'])
         else:
-            print('Joining population data...')
-            df = gp.sjoin(self.school_data, df, how = 'inner', op = 'contains')
-            df.drop(columns='index_right', inplace=True)
-            df = df.groupby('source_school_id').sum().reset_index()
-            df = df[['source_school_id', 'population']]
-            df.to_csv(self.data_dir + 'worldpop/school_agg_pop_' + self.country_code + '.csv', index=False)
+            centroids = self.get_centroids(df)
+            x, y = lonlat_to_tile(centroids[:, 0], centroids[:, 1])
+        index = QuadkeyIndex(x, y, weights=df['tests'].to_numpy() if 'tests' in df else None)
+
+        lon = self.school_data.longitude.to_numpy(dtype='float64')
+        lat = self.school_data.latitude.to_numpy(dtype='float64')
+        pos, ring = index.query(lon, lat, max_ring)
+
+        columns = pd.DataFrame({'source_school_id': self.school_data.source_school_id.values})
+        for feature in sub_features:
+            values = df[feature].to_numpy(dtype='float64')
+            if aggregate_ring is None:
+                columns[feature] = np.where(pos >= 0, values[pos], np.nan)
+            else:
+                # average over the aggregate rings, or over the ring the closest tile was found in if it is further
+                columns[feature] = index.aggregate(values, lon, lat, np.where(pos >= 0, np.maximum(ring, aggregate_ring), -1))
+
+        # schools without tiles within max_ring take the nearest tile
+        missing = pos < 0
+        if missing.any():
+            print(str(missing.sum()) + ' schools have no tile within ' + str(max_ring) + ' rings, mapping nearest tiles by KDtree...')
+            tree = self.build_tree(self.get_centroids(df))
+            dist, ind = self.query_tree(tree, np.column_stack([lon[missing], lat[missing]]))
+            for feature in sub_features:
+                columns.loc[missing, feature] = df[feature].to_numpy(dtype='float64')[ind]
 
-        return df
+        return columns
 
 
     def join_survey_schools(self):
@@ -236,14 +308,7 @@ class FeatureEngineering():
 
         # DROP DUPLICATES
         print('Dropping multiple area joins...')
-        for i in tqdm(list(set(school_survey.index[school_survey.index.duplicated()].tolist()))):
-            index_area = school_survey.loc[i, 'index_right'].tolist()
-            school_point = school_survey.loc[i, 'geometry'].tolist()[0].centroid
-            area_dist = [i.distance(school_point) for i in self.survey.loc[index_area, 'geometry'].tolist()]
-            min_index = index_area[area_dist.index(min(area_dist))]
-            min_row = school_survey[(school_survey.index==i) & (school_survey.index_right==min_index)]
-            school_survey.drop(index=i, inplace=True)
-            school_survey = school_survey.append(min_row)
+        school_survey = self.closest_survey_areas(school_survey)
         
         school_survey.drop(columns='index_right', inplace=True)
 
@@ -252,9 +317,123 @@ class FeatureEngineering():
         return school_survey
     
 
-    def set_training_data(self):
+    def closest_survey_areas(self, school_survey):
+        """
+        Keep the closest enumeration area for schools joined to multiple areas
+        :param school_survey: dataframe of school and area pairs from spatial join, index_right holds the area index
+        :return: school_survey - dataframe with one area per school
+        """
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            school_points = gp.GeoSeries(school_survey.geometry.values).centroid
+
+        # distances between school locations and their joined areas, computed for all pairs at once
+        areas = gp.GeoSeries(self.survey.loc[school_survey.index_right, 'geometry'].values)
+        area_dist = pd.Series(areas.distance(school_points).to_numpy())
+
+        # position of the closest area for each school; ties resolve to the first joined area
+        closest = area_dist.groupby(school_survey.index.to_numpy()).idxmin()
+
+        return school_survey.iloc[np.sort(closest.to_numpy())]
+    
+
+    def join_survey_tiles(self, radius=configs.SURVEY_NEAREST_RADIUS):
+        """
+        Join schools to the survey areas (provinces, barangays, etc.) containing them; all schools are resolved with one spatial index query
+        over the survey areas, schools outside every area take the area with the nearest edge
+        :param radius: initial search radius for schools outside every area, in degrees
+        :return: school_data - school dataframe with target added
+        """
+        print('Joining survey data to schools...')
+        survey = gp.GeoDataFrame({'target': self.survey['target'].to_numpy()}, geometry=self.survey.geometry.values, crs='EPSG:4326')
+        points = gp.GeoDataFrame(geometry=gp.points_from_xy(self.school_data.longitude, self.school_data.latitude), crs='EPSG:4326')
+
+        area = np.full(len(points), -1)
+        joined = gp.sjoin(points, survey, how='inner', op='within')
+        # schools within overlapping areas take the first joined area
+        joined = joined[~joined.index.duplicated()]
+        area[joined.index.to_numpy()] = joined.index_right.to_numpy()
+
+        outside = np.flatnonzero(area < 0)
+        if len(outside):
+            print(str(len(outside)) + ' schools are outside of the survey areas, joining areas with the nearest edge...')
+            area[outside] = self.nearest_survey_areas(points.iloc[outside].reset_index(drop=True), survey, radius)
+
+        school_data = self.school_data.copy()
+        school_data['target'] = survey.target.to_numpy()[area]
+        return school_data
+
+
+    def nearest_survey_areas(self, points, survey, radius):
+        """
+        Find the survey areas with the nearest edge to points; areas intersecting a square around each point are compared by exact distance,
+        the square is doubled for points whose nearest candidate is further than its radius
+        :param points: geodataframe of school points with range index
+        :param survey: geodataframe of survey areas with range index
+        :param radius: initial half width of the square, in degrees
+        :return: area - position of the nearest survey area for every point
+        """
+        if len(survey) == 0:
+            raise ValueError('Survey data has no areas to join schools to!')
+
+        area = np.full(len(points), -1)
+        pending = np.arange(len(points))
+        while len(pending):
+            squares = gp.GeoDataFrame(geometry=points.geometry.iloc[pending].buffer(radius, cap_style=3).values, crs='EPSG:4326')
+            pairs = gp.sjoin(squares, survey[['geometry']], how='inner', op='intersects')
+
+            if len(pairs):
+                left = pending[pairs.index.to_numpy()]
+                right = pairs.index_right.to_numpy()
+                candidates = pd.DataFrame({'point': left, 'area': right, 'dist': gp.GeoSeries(survey.geometry.values[right]).distance(gp.GeoSeries(points.geometry.values[left])).to_numpy()})
+
+                # areas outside the square may still be closer than the nearest candidate further than radius
+                nearest = candidates.loc[candidates.groupby('point').dist.idxmin()]
+                nearest = nearest[nearest.dist <= radius]
+                area[nearest.point.to_numpy()] = nearest.area.to_numpy()
+
+            pending = pending[area[pending] < 0]
+            radius *= 2
+
+        return area
+
+
+    def set_training_data(self, n_jobs=configs.FEATURE_N_JOBS, pool=configs.FEATURE_POOL, incremental=configs.FEATURE_INCREMENTAL):
+        """
+        Map all features in configs.FEATURES to schools
+        :param n_jobs: number of features loaded and joined concurrently, 1 maps features one after another, -1 or 0 for all cores
+        :param pool: 'thread' or 'process' pool for concurrent mapping
+        :param incremental: reuse cached columns of features whose inputs did not change since the last run
+        """
+        # the manifest is only kept for incremental runs; other runs rebuild every feature and write nothing to interim/features
+        stale = list(configs.FEATURES)
+        if incremental:
+            manifest = FeatureManifest(self.country_code, self.data_dir)
+            school_hash = manifest.get_school_hash(self.school_data)
+            stale = [i for i in configs.FEATURES if not manifest.is_fresh(i, school_hash)]
+            print('Features to rebuild: ' + (', '.join(stale) if stale else 'none'))
+
+        if n_jobs is not None and n_jobs <= 0:
+            n_jobs = os.cpu_count()
+
+        results = {}
+        if n_jobs != 1 and len(stale) > 1:
+            executor = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+            with executor(max_workers=n_jobs) as ex:
+                results = dict(zip(stale, ex.map(self.get_feature_columns, stale)))
+
+        # merge in configs.FEATURES order so columns match the sequential run
         for feature in configs.FEATURES:
-            self.map_feature(feature)
+            if feature in stale:
+                columns, by_id = results[feature] if feature in results else self.get_feature_columns(feature)
+                if incremental:
+                    manifest.save(feature, columns, by_id, school_hash)
+            else:
+                print('Reading cached ' + feature + ' features...')
+                columns, by_id = manifest.load(feature)
+
+            self.join_feature_columns(columns, by_id)
+            print(feature.title() + ' features added to the dataset!')
 
 
     def get_opendata(self):
@@ -271,7 +450,7 @@ class FeatureEngineering():
                 except:
                     raise RuntimeError('Unable to download from ' + pop_url)
 
-                feature_data[feature] = tif_to_gdf(pop)
+                feature_data[feature] = tif_to_gdf(pop, compact=configs.POPULATION_COMPACT, block_size=configs.RASTER_BLOCK_SIZE)
             else:
                 feature_data[feature] = eval(feature.title() + 'Data("' + self.country_code + '")').data
         
@@ -290,7 +469,8 @@ class FeatureEngineering():
         """
         ts_dir = self.data_dir + 'training_sets/' + self.country + '/'
 
-        lst = sorted(os.listdir(ts_dir))
+        # only training set csv files count as versions; feather matrices and other files share the directory
+        lst = sorted(i for i in os.listdir(ts_dir) if re.fullmatch(r'training_set_v\d{3}\.csv', i))
         if len(lst) == 0:
             v_no = 1
         else:
@@ -303,4 +483,19 @@ class FeatureEngineering():
             self.school_data.to_csv(out, index= False)
             os.chmod(path, stat.S_IRWXO)
         print('Training dataset version ' + v_no + ' saved!')
-        out.close()
\ No newline at end of file
+        out.close()
+
+        self.save_training_matrix(ts_dir + 'training_set_v' + v_no + '.feather')
+
+
+    def save_training_matrix(self, path):
+        """
+        Save numeric columns of the dataset as uncompressed float32 feather file that trainers can memory-map
+        :param path: path of the feather file
+        """
+        matrix = self.school_data.select_dtypes(include=['number', 'bool'])
+        matrix = matrix.astype({i: 'float32' for i in matrix.columns if i != 'source_school_id'})
+
+        matrix.reset_index(drop=True).to_feather(path, compression='uncompressed')
+        os.chmod(path, stat.S_IRWXO)
+        print('Training matrix saved!')
@@ -0,0 +1,126 @@
+"""LOAD DEPENDENCIES"""
+import hashlib
+import json
+import os
+import pandas as pd
+
+
+"""LOAD MODULES"""
+from feature_engineering import configs
+from data_gathering.opendata_scrap import get_pop_url, get_speedtest_url
+from data_gathering.opendata_utils import get_parquet_path, get_pop_cache_name, get_facebook_cache_name, get_satellite_cache_name
+
+
+"""CONFIG VALUES EACH FEATURE DEPENDS ON"""
+FEATURE_CONFIGS = {
+    'population': ['POPULATION_DATASET_YEAR', 'POPULATION_JOIN', 'POPULATION_COVERAGE', 'SCHOOL_BUFFER'],
+    'speedtest': ['SPEEDTEST_TILE_TYPE', 'SPEEDTEST_TILE_YEAR', 'SPEEDTEST_TILE_QUARTER', 'SPEEDTEST_JOIN', 'SPEEDTEST_MAX_RING', 'SPEEDTEST_AGGREGATE_RING'],
+    'opencell': [],
+    'facebook': ['FACEBOOK_RADIUS'],
+    'satellite': ['SATELITTE_COLLECTIONS', 'SATELITTE_START_YEAR', 'SATELITTE_END_YEAR', 'SATELITTE_BUFFER', 'SATELITTE_IMAGE_SCALE'],
+}
+
+
+"""FEATURE MANIFEST CLASS"""
+class FeatureManifest:
+    """
+    Manifest of mapped features; records fingerprint of the inputs of each feature (source files, config values, school set)
+    and caches the feature columns so unchanged features are not rebuilt
+    """
+    def __init__(self, country_code, data_dir = configs.WD + 'data/'):
+        self.country_code = country_code.lower()
+        self.data_dir = data_dir
+        self.wd = data_dir + 'interim/features/' + self.country_code + '/'
+        self.path = self.wd + 'manifest.json'
+        os.makedirs(self.wd, exist_ok=True)
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'features': {}, 'files': {}}
+
+
+    """returns source files the feature is built from; school joined datasets are cached under names keyed on their config values,
+    so a changed config points to a missing cache and the feature is rebuilt from scratch instead of from the stale one"""
+    def get_sources(self, feature):
+        sources = [self.data_dir + 'meta/' + feature + '_dict.xlsx']
+
+        if feature == 'population':
+            pop_url, pop_name = get_pop_url(self.country_code, configs.POPULATION_DATASET_YEAR)
+            sources.append(self.data_dir + 'worldpop/' + pop_name)
+            sources.append(self.data_dir + 'worldpop/' + get_pop_cache_name(self.country_code, configs.POPULATION_DATASET_YEAR, configs.POPULATION_JOIN, configs.POPULATION_COVERAGE, configs.SCHOOL_BUFFER))
+        elif feature == 'speedtest':
+            tile_url, tile_name = get_speedtest_url(configs.SPEEDTEST_TILE_TYPE, configs.SPEEDTEST_TILE_YEAR, configs.SPEEDTEST_TILE_QUARTER)
+            sources.append(self.data_dir + 'speedtest/' + tile_name[:-4] + '_' + self.country_code + '.csv')
+        elif feature == 'opencell':
+            sources.append(self.data_dir + 'opencellid/' + self.country_code + '.csv.gz')
+        elif feature == 'facebook':
+            sources.append(self.data_dir + 'fb/' + get_facebook_cache_name(self.country_code, configs.FACEBOOK_SCHOOL_DATA_LEN.get(self.country_code), configs.FACEBOOK_RADIUS))
+        elif feature == 'satellite':
+            sources.append(self.data_dir + 'satellite/' + get_satellite_cache_name(self.country_code, configs.SATELITTE_COLLECTIONS, configs.SATELITTE_START_YEAR, configs.SATELITTE_END_YEAR, configs.SATELITTE_BUFFER, configs.SATELITTE_IMAGE_SCALE))
+
+        # cached datasets may be stored as geoparquet instead of csv
+        sources += [get_parquet_path(i) for i in sources[1:] if i.endswith(('.csv', '.csv.gz'))]
+
+        return sources
+
+
+    """returns sha256 of file; hashes are reused while file size and modification time are unchanged"""
+    def get_file_hash(self, path):
+        if not os.path.exists(path):
+            return None
+
+        stat = os.stat(path)
+        cached = self.manifest['files'].get(path)
+        if cached is not None and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+            return cached['sha256']
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024**2), b''):
+                h.update(chunk)
+
+        self.manifest['files'][path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': h.hexdigest()}
+        return h.hexdigest()
+
+
+    """returns hash of school ids and locations"""
+    def get_school_hash(self, school_data):
+        hashes = pd.util.hash_pandas_object(school_data[['source_school_id', 'longitude', 'latitude']], index=False)
+        return hashlib.sha256(hashes.values.tobytes()).hexdigest()
+
+
+    """returns fingerprint of feature inputs"""
+    def get_fingerprint(self, feature, school_hash):
+        inputs = {
+            'configs': {i: repr(getattr(configs, i)) for i in FEATURE_CONFIGS.get(feature, [])},
+            'sources': {i: self.get_file_hash(i) for i in self.get_sources(feature)},
+            'schools': school_hash,
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+    """returns True if cached columns of feature were built from the same inputs"""
+    def is_fresh(self, feature, school_hash):
+        entry = self.manifest['features'].get(feature)
+        if entry is None or not os.path.exists(self.wd + entry['columns']):
+            return False
+        return entry['fingerprint'] == self.get_fingerprint(feature, school_hash)
+
+
+    """returns cached feature columns and whether they are joined by school id"""
+    def load(self, feature):
+        entry = self.manifest['features'][feature]
+        return pd.read_pickle(self.wd + entry['columns']), entry['by_id']
+
+
+    """caches feature columns and records fingerprint of their inputs"""
+    def save(self, feature, columns, by_id, school_hash):
+        file_name = feature + '.pickle'
+        pd.DataFrame(columns).to_pickle(self.wd + file_name)
+
+        self.manifest['features'][feature] = {'fingerprint': self.get_fingerprint(feature, school_hash), 'by_id': bool(by_id), 'columns': file_name}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,125 @@
+"""LOAD DEPENDENCIES"""
+import numpy as np
+import pandas as pd
+
+
+"""LOAD MODULES"""
+from feature_engineering import configs
+
+
+"""WEB MERCATOR TILE COORDINATES"""
+MAX_LATITUDE = 85.05112878
+
+"""returns x, y coordinates of the tiles containing lon, lat at zoom level, vectorized"""
+def lonlat_to_tile(lon, lat, zoom=configs.SPEEDTEST_TILE_ZOOM):
+    n = 2 ** zoom
+    lon = np.asarray(lon, dtype='float64')
+    lat = np.radians(np.clip(np.asarray(lat, dtype='float64'), -MAX_LATITUDE, MAX_LATITUDE))
+
+    x = np.floor((lon + 180) / 360 * n)
+    y = np.floor((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n)
+    return np.clip(x, 0, n - 1).astype('int64'), np.clip(y, 0, n - 1).astype('int64')
+
+
+"""returns lon, lat of the centres of tiles x, y at zoom level, vectorized"""
+def tile_to_lonlat(x, y, zoom=configs.SPEEDTEST_TILE_ZOOM):
+    n = 2 ** zoom
+    lon = (np.asarray(x) + 0.5) / n * 360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (np.asarray(y) + 0.5) / n))))
+    return lon, lat
+
+
+"""returns x, y coordinates of the tiles of quadkeys at zoom level, vectorized; quadkeys read as integers get their leading zeros back"""
+def quadkey_to_tile(quadkeys, zoom=configs.SPEEDTEST_TILE_ZOOM):
+    quadkeys = pd.Series(quadkeys).astype(str).str.zfill(zoom)
+    digits = quadkeys.to_numpy(dtype='S' + str(zoom)).view('uint8').reshape(-1, zoom).astype('int64') - ord('0')
+
+    bits = 2 ** np.arange(zoom - 1, -1, -1, dtype='int64')
+    return (digits & 1) @ bits, (digits >> 1) @ bits
+
+
+"""QUADKEY INDEX CLASS"""
+class QuadkeyIndex:
+    """
+    Hash index of tiles by tile coordinates; school tiles are looked up in constant time, missing tiles are searched for
+    ring by ring over the neighbouring tiles
+    """
+    def __init__(self, x, y, weights=None, zoom=configs.SPEEDTEST_TILE_ZOOM):
+        self.zoom = zoom
+        self.n = 2 ** zoom
+        keys = np.asarray(x, dtype='int64') * self.n + np.asarray(y, dtype='int64')
+
+        # duplicated tiles resolve to the first one
+        first = ~pd.Index(keys).duplicated()
+        self.positions = np.flatnonzero(first)
+        self.index = pd.Index(keys[first])
+        self.weights = np.ones(len(keys)) if weights is None else np.nan_to_num(np.asarray(weights, dtype='float64'))
+
+
+    """returns positions of tiles x, y, -1 for missing tiles"""
+    def lookup(self, x, y):
+        if len(self.index) == 0:
+            return np.full(len(x), -1)
+        valid = (x >= 0) & (x < self.n) & (y >= 0) & (y < self.n)
+        found = self.index.get_indexer(np.where(valid, x * self.n + y, -1))
+        return np.where(valid & (found >= 0), self.positions[found], -1)
+
+
+    """returns (dx, dy) offsets of the tiles in ring r around a tile"""
+    def ring_offsets(self, r):
+        if r == 0:
+            return [(0, 0)]
+        return [(dx, dy) for dx in range(-r, r + 1) for dy in range(-r, r + 1) if max(abs(dx), abs(dy)) == r]
+
+
+    """returns position of the tile containing each location and ring it was found in; if the tile is missing, the tile with the closest
+    centre in the first ring holding any tile is taken, locations without tiles within max_ring get position and ring -1"""
+    def query(self, lon, lat, max_ring=configs.SPEEDTEST_MAX_RING):
+        lon = np.asarray(lon, dtype='float64')
+        lat = np.asarray(lat, dtype='float64')
+        x, y = lonlat_to_tile(lon, lat, self.zoom)
+
+        pos = self.lookup(x, y)
+        ring = np.where(pos >= 0, 0, -1)
+
+        for r in range(1, max_ring + 1):
+            missing = np.flatnonzero(pos < 0)
+            if len(missing) == 0:
+                break
+
+            best_pos = np.full(len(missing), -1)
+            best_dist = np.full(len(missing), np.inf)
+            for dx, dy in self.ring_offsets(r):
+                found = self.lookup(x[missing] + dx, y[missing] + dy)
+                centre_lon, centre_lat = tile_to_lonlat(x[missing] + dx, y[missing] + dy, self.zoom)
+                dist = np.where(found >= 0, np.hypot(centre_lon - lon[missing], centre_lat - lat[missing]), np.inf)
+
+                closer = dist < best_dist
+                best_pos[closer] = found[closer]
+                best_dist[closer] = dist[closer]
+
+            pos[missing] = best_pos
+            ring[missing[best_pos >= 0]] = r
+
+        return pos, ring
+
+
+    """returns weighted mean of values over the tiles within rings[i] rings around each location, NaN where no tile is found"""
+    def aggregate(self, values, lon, lat, rings):
+        x, y = lonlat_to_tile(lon, lat, self.zoom)
+        values = np.asarray(values, dtype='float64')
+        rings = np.asarray(rings)
+
+        sums = np.zeros(len(x))
+        weights = np.zeros(len(x))
+        for r in range(0, max(int(rings.max(initial=0)), 0) + 1):
+            within = np.flatnonzero(rings >= r)
+            for dx, dy in self.ring_offsets(r):
+                found = self.lookup(x[within] + dx, y[within] + dy)
+                hit = found >= 0
+                w = self.weights[found[hit]] * np.isfinite(values[found[hit]])
+                sums[within[hit]] += w * np.nan_to_num(values[found[hit]])
+                weights[within[hit]] += w
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weights > 0, sums / weights, np.nan)
@@ -0,0 +1,91 @@
+"""LOAD DEPENDENCIES"""
+import hashlib
+import pickle
+import os
+import numpy as np
+from sklearn.neighbors import KDTree
+
+
+"""LOAD MODULES"""
+from feature_engineering import configs
+
+
+"""KD TREE CACHE CLASS"""
+class TreeCache:
+    """
+    Content addressed cache of KD trees; trees are keyed by a hash of the source locations and tree parameters,
+    least recently used trees are evicted once the cache exceeds its size limit
+    """
+    def __init__(self, wd = configs.WD + 'data/interim/kdtree/', max_size = configs.KDTREE_CACHE_SIZE):
+        self.wd = wd
+        self.max_size = max_size * 1024**2
+        os.makedirs(self.wd, exist_ok=True)
+
+
+    """returns cache key of the locations and tree parameters"""
+    def get_key(self, centroids, **params):
+        centroids = np.ascontiguousarray(centroids, dtype='float64')
+        h = hashlib.sha256()
+        h.update(str(centroids.shape).encode())
+        h.update(centroids.tobytes())
+        h.update(repr(sorted(params.items())).encode())
+        return h.hexdigest()
+
+
+    """returns cached tree for the key, None if the tree is not cached"""
+    def get(self, key):
+        path = self.wd + key + '.pickle'
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'rb') as input_file:
+                tree = pickle.load(input_file)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            print('Cached tree is corrupt, it will be rebuilt.')
+            os.remove(path)
+            return None
+
+        # mark the tree as recently used
+        os.utime(path)
+        return tree
+
+
+    """writes tree to the cache and evicts least recently used trees"""
+    def put(self, key, tree):
+        path = self.wd + key + '.pickle'
+        with open(path + '.tmp', 'wb') as output_file:
+            pickle.dump(tree, output_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+        self.evict(keep=path)
+
+
+    """removes least recently used trees until the cache fits into max_size"""
+    def evict(self, keep=None):
+        files = [self.wd + i for i in os.listdir(self.wd) if i.endswith('.pickle')]
+        files = sorted(files, key=os.path.getmtime)
+        total = sum(os.path.getsize(i) for i in files)
+
+        for path in files:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+
+    """returns cached tree of the locations, builds and caches it if it does not exist"""
+    def get_tree(self, centroids, leaf_size = configs.KDTREE_LEAF_SIZE):
+        centroids = np.ascontiguousarray(centroids, dtype='float64')
+        key = self.get_key(centroids, leaf_size=leaf_size, tree='KDTree')
+
+        tree = self.get(key)
+        if tree is None:
+            print('Constructing KD tree..')
+            tree = KDTree(centroids, leaf_size=leaf_size)
+            self.put(key, tree)
+        else:
+            print('Reading KD tree from cache...')
+
+        return tree
@@ -3,21 +3,23 @@
 from feature_engineering.data_pipeline import *
 
 
-"""Initialize the feature engineering class; set the school data"""
-itu = FeatureEngineering()
+"""runs the pipeline only when main.py is executed, worker processes of FEATURE_POOL = 'process' import it without running it"""
+if __name__ == '__main__':
+    """Initialize the feature engineering class; set the school data"""
+    itu = FeatureEngineering()
 
 
-"""Shows the school dataset"""
-# itu.school_data 
+    """Shows the school dataset"""
+    # itu.school_data 
 
 
-"""Calls OpenData classes of features listed in configs.FEATURES, joins them to school data"""
-itu.set_training_data()
+    """Calls OpenData classes of features listed in configs.FEATURES, joins them to school data"""
+    itu.set_training_data()
 
 
-"""Saves the training set with features"""
-itu.save_training_set()
+    """Saves the training set with features"""
+    itu.save_training_set()
 
 
-"""Calls OpenData classes of features listed in configs.FEATURES and returns dictionary with feature names as keys and datasets as values"""
-opendata = itu.get_opendata()
\ No newline at end of file
+    """Calls OpenData classes of features listed in configs.FEATURES and returns dictionary with feature names as keys and datasets as values"""
+    opendata = itu.get_opendata()
@@ -10,6 +10,7 @@ from shapely.geometry import Point
 """ LOAD MODULES"""
 from country import *
 from data_gathering.opendata_scrap import osm_to_json, get_osm_schools
+from data_gathering.opendata_utils import cache_exists, read_cache, write_cache
 
 
 
@@ -27,16 +28,16 @@ class School(Country):
 
     """function to get raw school location data"""
     def set_school_data(self):
-        if os.path.exists(self.wd + 'school_latlon_' + self.country_code.lower() + '.csv'):
+        if cache_exists(self.wd + 'school_latlon_' + self.country_code.lower() + '.csv'):
             print('Reading school data...')
             try:
-                self.data = pd.read_csv(self.wd + 'school_latlon_' + self.country_code.lower() + '.csv')
+                self.data = read_cache(self.wd + 'school_latlon_' + self.country_code.lower() + '.csv')
             except:
                 raise RuntimeError('Error reading the school location data!')
         else:
             print('Gettin school location data from OpenStreetMap database...')
             self.data = get_osm_schools(self.country_code)
-            self.data.to_csv(self.wd + 'school_latlon_' + self.country_code.lower() + '.csv', index=False)
+            write_cache(self.data, self.wd + 'school_latlon_' + self.country_code.lower() + '.csv')
         
         self.data = self.school_prep()
 
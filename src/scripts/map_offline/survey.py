@@ -3,16 +3,19 @@
 from bs4 import BeautifulSoup, SoupStrainer
 from pandas._config import config
 import savReaderWriter as savr
-import httplib2
 from tqdm import tqdm
 import geopandas as gp
 import pandas as pd
 import os
+import io
+from urllib.request import urlopen
+from itertools import islice
 
 
 """LOAD MODULES"""
 from country import *
 from data_gathering.opendata_utils import *
+from data_gathering.downloads import get_download_manager
 
 
 """SURVEY CLASS AS SUBCLASS OF COUNTRY"""
@@ -24,7 +27,8 @@ class Survey(Country):
         self.func_map = {i: i.upper() + '_Survey' for i in self.available_countries}
         
         if (self.country_code.upper() + '_Survey') in self.func_map.values():
-            self.data = eval(self.func_map[self.country_code] + '()').data
+            survey = eval(self.func_map[self.country_code] + '()')
+            self.data = get_simplified(survey.data, survey.wd + 'survey_' + self.country_code.lower() + '.csv')
         else:
             self.data = None
             print('Survey data for ' + self.country_name + ' not exist! Continue without ground truth!')
@@ -38,33 +42,53 @@ class BRA_Survey(Survey):
         self.data = self.set_survey_data()
 
 
-    """returns links for brazil enumeration area shape files"""
+    """returns links for brazil enumeration area shape files; state folders are listed concurrently"""
     def get_area_links(self):
         base_url = "https://geoftp.ibge.gov.br/organizacao_do_territorio/malhas_territoriais/malhas_de_setores_censitarios__divisoes_intramunicipais/censo_2010/setores_censitarios_shp/"
-        links=[]
+        manager = get_download_manager()
 
-        http = httplib2.Http()
-        status, response = http.request(base_url)
+        response = manager.fetch(base_url)
+        states = [link['href'] for link in BeautifulSoup(response, 'html.parser', parse_only=SoupStrainer('a')) if link.has_attr('href') and len(link['href'])==3]
 
-        for link in BeautifulSoup(response, 'html.parser', parse_only=SoupStrainer('a')):
-            if link.has_attr('href') and len(link['href'])==3:
-                    status2, response2 = http.request(base_url+link['href'])
-                    for link2 in BeautifulSoup(response2, 'html.parser', parse_only=SoupStrainer('a')):
-                        if link2.has_attr('href') and link2['href'].endswith('_setores_censitarios.zip'):
-                            print(link['href']+link2['href'])
-                            links.append(link['href']+link2['href'])
+        links=[]
+        for state, response2 in zip(states, manager.map([base_url + i for i in states])):
+            for link2 in BeautifulSoup(response2, 'html.parser', parse_only=SoupStrainer('a')):
+                if link2.has_attr('href') and link2['href'].endswith('_setores_censitarios.zip'):
+                    print(state+link2['href'])
+                    links.append(state+link2['href'])
         
         return base_url, links
 
 
+    """returns variables of the survey microdata; only the selected variables are decoded, in record batches, and they are cached as parquet next to the sav file"""
+    def read_survey(self, variables = ('CODSETOR', 'A4A'), batch_size = configs.SURVEY_BATCH_SIZE):
+        variables = list(variables)
+        sav_path = self.wd + 'EA_2019.sav'
+        cache_path = self.wd + 'EA_2019_' + '_'.join(variables).lower() + '.parquet'
+
+        if os.path.exists(cache_path) and (not os.path.exists(sav_path) or os.path.getmtime(cache_path) >= os.path.getmtime(sav_path)):
+            print('Reading projected survey data...')
+            return read_parquet(cache_path)
+
+        batches = []
+        with savr.SavReader(sav_path, selectVars = variables, ioUtf8 = True) as reader:
+            header = reader.header
+            records = iter(reader)
+            for batch in tqdm(iter(lambda: list(islice(records, batch_size)), [])):
+                batches.append(pd.DataFrame(batch, columns = header))
+
+        df_survey = pd.concat(batches, ignore_index=True) if batches else pd.DataFrame(columns = header)
+        write_parquet(df_survey, cache_path)
+
+        return df_survey
+
+
     def set_survey_data(self):
         
-        if os.path.exists(self.wd + 'survey_bra.csv'):
+        if cache_exists(self.wd + 'survey_bra.csv'):
             print('Reading survey data for Brazil...')
             try:
-                df_area = pd.read_csv(self.wd + "survey_bra.csv")
-                df_area = df_area[df_area.geometry.isna()==False]
-                gdf = df_to_gdf(df_area)
+                gdf = read_cache(self.wd + 'survey_bra.csv')
             except:
                 raise RuntimeError('Unable to read survey data!')
 
@@ -72,9 +96,8 @@ class BRA_Survey(Survey):
             print('Downloading enumeration area shape files...')
             try:
                 base_url, links = self.get_area_links()
-                gdf_area = gp.GeoDataFrame()
-                for link in tqdm(links):
-                    gdf_area = gp.GeoDataFrame(pd.concat([gdf_area, gp.read_file(base_url+link)], ignore_index=True))
+                areas = get_download_manager().map([base_url + i for i in links], lambda response: gp.read_file(io.BytesIO(response.content)))
+                gdf_area = gp.GeoDataFrame(pd.concat(areas, ignore_index=True))
             except:
                 raise RuntimeError('Unable to download enumeration area shape files!')
             
@@ -86,14 +109,13 @@ class BRA_Survey(Survey):
             """ SURVEY DATA """
             print('Reading raw survey data for Brazil...')
             try:
-                with savr.SavReader(self.wd + 'EA_2019.sav', ioUtf8 = True) as reader:
-                    df_survey = pd.DataFrame(reader.all(), columns = reader.header)
+                df_survey = self.read_survey()
             except:
                 raise RuntimeError('Unable to read raw survey dataset!')
             
             # edit the CODSETOR variable in order to match survey data and enumeration area data
             df_survey.CODSETOR = df_survey.CODSETOR.astype(str)
-            df_survey['CD_GEOCODI'] = [i[:-2] for i in df_survey.CODSETOR]
+            df_survey['CD_GEOCODI'] = df_survey.CODSETOR.str[:-2]
 
             # join areas to survey data
             print('Joining enumeration area geometries with survey data...')
@@ -102,7 +124,7 @@ class BRA_Survey(Survey):
             gdf = gp.GeoDataFrame(dff, crs="EPSG:4326", geometry=dff.geometry)
             gdf = gdf[['A4A', 'geometry']]
             gdf.rename(columns = {'A4A': 'target'}, inplace = True)
-            gdf.to_csv(self.wd + 'survey_bra.csv', index = False)
+            write_cache(gdf, self.wd + 'survey_bra.csv')
         
         return gdf
 
@@ -117,22 +139,20 @@ class THA_Survey(Survey):
     
     def set_survey_data(self):
 
-        if os.path.exists(self.wd + 'survey_tha.csv'):
+        if cache_exists(self.wd + 'survey_tha.csv'):
             print('Reading survey data for Thailand...')
             try:
-                survey_pro = pd.read_csv(self.wd + "survey_tha.csv")
-                survey_pro = df_to_gdf(survey_pro)
+                survey_pro = read_cache(self.wd + 'survey_tha.csv')
             except:
                 raise RuntimeError('Unable to read survey data!')
 
         else:
 
             # reading province shape files
-            if os.path.exists(self.wd + '../../geodata/tha_pro.csv'):
+            if cache_exists(self.wd + '../../geodata/tha_pro.csv'):
                 print('Reading province data for Thailand...')
                 try:
-                    provinces = pd.read_csv(self.wd + '../../geodata/tha_pro.csv')
-                    provinces = df_to_gdf(provinces)
+                    provinces = read_cache(self.wd + '../../geodata/tha_pro.csv')
                 except:
                     raise RuntimeError('Unable to read province data!')
                     
@@ -144,7 +164,7 @@ class THA_Survey(Survey):
                     provinces['ADM1_PCODE'] = [int(i[2:]) for i in provinces['ADM1_PCODE']]
                     provinces.rename(columns = {'ADM1_EN': 'name', 'ADM1_PCODE': 'CWT'}, inplace=True)
                     provinces = provinces[['CWT', 'name', 'geometry']]
-                    provinces.to_csv(self.wd + '../../geodata/tha_pro.csv')
+                    write_cache(provinces, self.wd + '../../geodata/tha_pro.csv')
                 except:
                     raise RuntimeError('Unable to download province data!')
 
@@ -164,7 +184,7 @@ class THA_Survey(Survey):
             survey_pro.dropna(subset = ['target', 'geometry'], inplace = True)
             survey_pro_mean = survey_pro.groupby('CWT').mean().reset_index()
             survey_pro = survey_pro_mean.merge(provinces)[['target', 'geometry']]
-            survey_pro.to_csv(self.wd + 'survey_tha.csv', index = False)
+            write_cache(survey_pro, self.wd + 'survey_tha.csv')
 
         return gp.GeoDataFrame(survey_pro, crs='epsg:4326')
 
@@ -176,11 +196,10 @@ class PHL_Survey(Survey):
 
     
     def set_survey_data(self):
-        if os.path.exists(self.wd + 'survey_phl.csv'):
+        if cache_exists(self.wd + 'survey_phl.csv'):
             print('Reading survey data for Philippines...')
             try:
-                survey_brgy = pd.read_csv(self.wd + "survey_phl.csv")
-                survey_brgy = df_to_gdf(survey_brgy)
+                survey_brgy = read_cache(self.wd + 'survey_phl.csv')
             except:
                 raise RuntimeError('Unable to read survey data!')
 
@@ -213,7 +232,7 @@ class PHL_Survey(Survey):
             survey_brgy.target = survey_brgy['target'].map(target_dict)
             survey_brgy_mean = survey_brgy.groupby(['prov', 'cit_mun', 'brgy']).mean()['target'].reset_index()
             survey_brgy = survey_brgy_mean.merge(brgys, on=['prov', 'cit_mun', 'brgy'])[['target','geometry']]
-            survey_brgy.to_csv(self.wd + 'survey_phl.csv', index = False)
+            write_cache(survey_brgy, self.wd + 'survey_phl.csv')
         
         return gp.GeoDataFrame(survey_brgy, crs='epsg:4326')
 
@@ -0,0 +1,101 @@
+"""LOAD DEPENDENCIES"""
+import os
+import sys
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+
+
+"""LOAD MODULES"""
+# modules import each other from the map_offline directory; feature_engineering is loaded first as in main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import feature_engineering
+
+
+"""LOCAL HTTP STAND-IN SERVER"""
+class StandInServer:
+    """
+    HTTP server on localhost answering every GET request with handle(request); requests are recorded with their path,
+    headers and arrival time, and the number of requests served at once is tracked
+    """
+    def __init__(self):
+        self.handle = None
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with server.lock:
+                    server.requests.append({'path': self.path, 'headers': dict(self.headers), 'time': time.monotonic()})
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                try:
+                    server.handle(self)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:' + str(self.httpd.server_address[1])
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+"""writes response with status, body and headers to request"""
+def respond(request, status=200, body=b'', headers=None):
+    request.send_response(status)
+    headers = dict(headers or {})
+    headers.setdefault('Content-Length', str(len(body)))
+    for key, value in headers.items():
+        request.send_header(key, value)
+    request.end_headers()
+    request.wfile.write(body)
+
+
+"""FROZEN CLOCK OF THE DOWNLOAD MANAGER"""
+class FrozenClock:
+    """
+    Stand-in of the time module in data_gathering.downloads; the clock does not advance and sleeps return at once,
+    so waits for backoff and request spacing are recorded instead of timed
+    """
+    def __init__(self):
+        self.sleeps = []
+        self.lock = threading.Lock()
+
+    def monotonic(self):
+        return 0.0
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.sleeps.append(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    from data_gathering import downloads
+    clock = FrozenClock()
+    monkeypatch.setattr(downloads, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def server():
+    server = StandInServer()
+    yield server
+    server.close()
@@ -0,0 +1,60 @@
+"""LOAD DEPENDENCIES"""
+import json
+import threading
+import pytest
+
+
+"""LOAD MODULES"""
+import country
+from data_gathering import downloads
+
+
+"""TWO SQUARE COUNTRIES SERVED AS countries.json"""
+COUNTRIES = {'type': 'FeatureCollection', 'features': [
+    {'type': 'Feature', 'id': 'AAA', 'properties': {'name': 'A'}, 'geometry': {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]]}},
+    {'type': 'Feature', 'id': 'BBB', 'properties': {'name': 'B'}, 'geometry': {'type': 'Polygon', 'coordinates': [[[1, 0], [2, 0], [2, 1], [1, 1], [1, 0]]]}},
+]}
+
+
+@pytest.fixture
+def countries(monkeypatch, tmp_path):
+    path = tmp_path / 'countries.json'
+    path.write_text(json.dumps(COUNTRIES))
+    loads = []
+
+    class Manager:
+        def download(self, url, target):
+            loads.append(url)
+            return str(path)
+
+    monkeypatch.setattr(downloads, 'get_download_manager', lambda: Manager())
+    monkeypatch.setattr(country, '_countries', None)
+    monkeypatch.setattr(country, '_country_geometries', {})
+    return loads
+
+
+def test_countries_are_loaded_once_by_concurrent_callers(countries):
+    start = threading.Barrier(8)
+
+    def load():
+        start.wait()
+        country.get_countries()
+        country.get_country_geometry('AAA')
+
+    threads = [threading.Thread(target=load) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(countries) == 1
+
+
+def test_callers_get_their_own_copy(countries):
+    country.get_countries().drop(index=0, inplace=True)
+    assert len(country.get_countries()) == 2
+
+    first = country.Country('AAA')
+    first.geodata['name'] = 'changed'
+    assert country.Country('AAA').geodata.name.tolist() == ['A']
+    assert country.get_country_geometry('AAA') is country.get_country_geometry('AAA')
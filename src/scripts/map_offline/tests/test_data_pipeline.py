@@ -0,0 +1,35 @@
+"""LOAD DEPENDENCIES"""
+import pandas as pd
+import pytest
+
+
+"""LOAD MODULES"""
+from feature_engineering.data_pipeline import FeatureEngineering
+
+
+"""returns feature engineering object holding schools with source_school_ids, without reading the school dataset"""
+def get_pipeline(source_school_ids):
+    pipeline = FeatureEngineering.__new__(FeatureEngineering)
+    pipeline.school_data = pd.DataFrame({'source_school_id': source_school_ids})
+    return pipeline
+
+
+def test_columns_in_school_order_are_joined_by_position():
+    pipeline = get_pipeline([1, 1, 2])
+
+    pipeline.join_feature_columns(pd.DataFrame({'source_school_id': [1, 1, 2], 'value': [10, 11, 12]}), by_id=False)
+    assert pipeline.school_data.value.tolist() == [10, 11, 12]
+
+
+def test_reordered_columns_are_joined_by_unique_id():
+    pipeline = get_pipeline([1, 1, 2])
+
+    pipeline.join_feature_columns(pd.DataFrame({'source_school_id': [2, 1], 'value': [5, 6]}), by_id=False)
+    assert pipeline.school_data.value.tolist() == [6, 6, 5]
+
+
+def test_reordered_columns_with_duplicate_ids_raise():
+    pipeline = get_pipeline([1, 1, 2])
+
+    with pytest.raises(ValueError):
+        pipeline.join_feature_columns(pd.DataFrame({'source_school_id': [2, 1, 1], 'value': [5, 6, 7]}), by_id=False)
@@ -0,0 +1,196 @@
+"""LOAD DEPENDENCIES"""
+import hashlib
+import json
+import os
+import threading
+import time
+import pytest
+import requests
+
+
+"""LOAD MODULES"""
+from conftest import respond
+from data_gathering.downloads import DownloadManager
+
+
+def get_manager(**kwargs):
+    kwargs = {'max_workers': 8, 'host_workers': 4, 'retries': 3, 'backoff': 0, 'timeout': 10, **kwargs}
+    return DownloadManager(**kwargs)
+
+
+"""RETRIES"""
+
+def test_fetch_retries_unavailable_server(server):
+    statuses = [503, 503, 200]
+    server.handle = lambda request: respond(request, statuses.pop(0), b'content')
+
+    assert get_manager().fetch(server.url + '/file') == b'content'
+    assert len(server.requests) == 3
+
+
+def test_fetch_raises_after_last_retry(server):
+    server.handle = lambda request: respond(request, 503)
+
+    with pytest.raises(requests.HTTPError):
+        get_manager(retries=2).fetch(server.url + '/file')
+    assert len(server.requests) == 3
+
+
+def test_fetch_does_not_retry_client_errors(server):
+    server.handle = lambda request: respond(request, 404)
+
+    with pytest.raises(requests.HTTPError):
+        get_manager().fetch(server.url + '/file')
+    assert len(server.requests) == 1
+
+
+def test_fetch_backs_off_exponentially(server, clock):
+    statuses = [503, 503, 503, 200]
+    server.handle = lambda request: respond(request, statuses.pop(0), b'content')
+
+    get_manager(backoff=0.5).fetch(server.url + '/file')
+    assert [i for i in clock.sleeps if i] == [0.5, 1, 2]
+
+
+"""CONCURRENCY AND ORDER"""
+
+def test_map_limits_concurrent_requests_per_host(server):
+    both_active = threading.Event()
+
+    def handle(request):
+        # the first request waits for a second one, so the limit is reached whatever the timing
+        if server.active >= 2:
+            both_active.set()
+        both_active.wait(timeout=5)
+        respond(request, 200, request.path.encode())
+    server.handle = handle
+
+    get_manager(max_workers=8, host_workers=2).map([server.url + '/' + str(i) for i in range(8)])
+    assert server.max_active == 2
+
+
+def test_map_spaces_request_starts(server, clock):
+    server.handle = lambda request: respond(request, 200, b'content')
+
+    get_manager(min_interval=0.5).map([server.url + '/' + str(i) for i in range(4)])
+    # the frozen clock makes every request wait for its slot from the same instant
+    assert sorted(clock.sleeps) == pytest.approx([0, 0.5, 1, 1.5])
+
+
+def test_map_returns_results_in_order(server):
+    def handle(request):
+        # later urls finish first
+        time.sleep(0.02 * (8 - int(request.path[1:])))
+        respond(request, 200, request.path.encode())
+    server.handle = handle
+
+    urls = [server.url + '/' + str(i) for i in range(8)]
+    assert get_manager().map(urls, lambda response: response.content.decode()) == ['/' + str(i) for i in range(8)]
+
+
+"""RESUMABLE DOWNLOADS"""
+
+# several chunks of the 1 MB chunks downloads are written in, chunks cut off by the truncation are downloaded again
+CONTENT = bytes(range(256)) * 4096 * 3
+ETAG = '"v1"'
+
+
+"""serves CONTENT; the first full response is cut off halfway, range requests validated by If-Range get the rest"""
+def get_truncating_handler():
+    state = {'truncated': False}
+
+    def handle(request):
+        ranged = request.headers.get('Range')
+        if ranged and request.headers.get('If-Range') == ETAG:
+            start = int(ranged.split('=')[1].rstrip('-'))
+            respond(request, 206, CONTENT[start:], {'ETag': ETAG, 'Content-Range': 'bytes {}-{}/{}'.format(start, len(CONTENT) - 1, len(CONTENT))})
+        elif not state['truncated']:
+            state['truncated'] = True
+            request.send_response(200)
+            request.send_header('Content-Length', str(len(CONTENT)))
+            request.send_header('ETag', ETAG)
+            request.end_headers()
+            request.wfile.write(CONTENT[:len(CONTENT) // 2])
+            request.wfile.flush()
+            request.close_connection = True
+        else:
+            respond(request, 200, CONTENT, {'ETag': ETAG})
+
+    return handle
+
+
+"""serves CONTENT, answers conditional requests with 304"""
+def get_conditional_handler():
+    def handle(request):
+        if request.headers.get('If-None-Match') == ETAG:
+            respond(request, 304, headers={'ETag': ETAG})
+        else:
+            respond(request, 200, CONTENT, {'ETag': ETAG})
+
+    return handle
+
+
+def test_download_resumes_truncated_body(server, tmp_path):
+    server.handle = get_truncating_handler()
+    path = str(tmp_path / 'file.bin')
+
+    assert get_manager().download(server.url + '/file.bin', path) == path
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+
+    assert len(server.requests) == 2
+    offset = int(server.requests[1]['headers']['Range'].split('=')[1].rstrip('-'))
+    assert 0 < offset <= len(CONTENT) // 2
+    assert server.requests[1]['headers']['If-Range'] == ETAG
+
+    with open(path + '.json') as f:
+        record = json.load(f)
+    assert record['size'] == len(CONTENT)
+    assert record['sha256'] == hashlib.sha256(CONTENT).hexdigest()
+    assert record['etag'] == ETAG
+
+
+def test_download_revalidates_unchanged_file(server, tmp_path):
+    server.handle = get_conditional_handler()
+    path = str(tmp_path / 'file.bin')
+
+    manager = get_manager()
+    manager.download(server.url + '/file.bin', path)
+    manager.download(server.url + '/file.bin', path)
+
+    assert len(server.requests) == 2
+    assert server.requests[1]['headers']['If-None-Match'] == ETAG
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_download_replaces_file_not_matching_its_checksum(server, tmp_path):
+    server.handle = get_conditional_handler()
+    path = str(tmp_path / 'file.bin')
+
+    manager = get_manager()
+    manager.download(server.url + '/file.bin', path)
+    # same size, different content and modification time
+    with open(path, 'r+b') as f:
+        f.write(b'corrupt')
+    os.utime(path, (0, 0))
+    manager.download(server.url + '/file.bin', path)
+
+    assert len(server.requests) == 2
+    assert 'If-None-Match' not in server.requests[1]['headers']
+    with open(path, 'rb') as f:
+        assert f.read() == CONTENT
+
+
+def test_download_verifies_checksum_only_after_modification(server, tmp_path):
+    server.handle = get_conditional_handler()
+    path = str(tmp_path / 'file.bin')
+
+    manager = get_manager(retries=0)
+    manager.download(server.url + '/file.bin', path, revalidate=False)
+    os.utime(path, (0, 0))
+    assert manager.download(server.url + '/file.bin', path, revalidate=False) == path
+
+    with open(path + '.json') as f:
+        assert json.load(f)['mtime'] == 0
+    assert len(server.requests) == 1
@@ -0,0 +1,92 @@
+"""LOAD DEPENDENCIES"""
+import numpy as np
+import geopandas as gp
+import pytest
+from shapely.geometry import Point, box
+
+
+"""LOAD MODULES"""
+from data_gathering.opendata_raster import zonal_sum, iter_raster_blocks, get_raster_windows
+
+
+NODATA = -99999.0
+
+
+"""IN MEMORY STAND-IN OF A GDAL DATASET"""
+class StandInRaster:
+
+    def __init__(self, values, gt=(0.0, 1.0, 0.0, 0.0, 0.0, -1.0), block=(16, 4)):
+        self.values = values
+        self.gt = gt
+        self.block = block
+        self.RasterYSize, self.RasterXSize = values.shape
+        self.reads = []
+
+    def GetGeoTransform(self):
+        return self.gt
+
+    def GetRasterBand(self, band):
+        return self
+
+    def GetNoDataValue(self):
+        return NODATA
+
+    def GetBlockSize(self):
+        return self.block
+
+    def ReadAsArray(self, col_off, row_off, cols, rows):
+        self.reads.append((col_off, row_off))
+        return self.values[row_off:row_off + rows, col_off:col_off + cols].copy()
+
+
+"""returns 40 x 40 raster of random values whose top left 16 x 16 pixels are nodata"""
+def get_raster():
+    values = np.random.default_rng(0).uniform(0, 10, (40, 40))
+    values[:16, :16] = NODATA
+    return StandInRaster(values)
+
+
+"""returns sums and counts of pixels with centre in each geometry"""
+def get_brute_force_sums(raster, geometries):
+    rows, cols = np.indices(raster.values.shape)
+    x, y = (cols + 0.5).ravel(), -(rows + 0.5).ravel()
+    values = np.where(raster.values == NODATA, 0, raster.values).ravel()
+
+    sums, counts = [], []
+    for geometry in geometries:
+        inside = np.array([geometry.contains(Point(i, j)) for i, j in zip(x, y)])
+        sums.append(values[inside].sum())
+        counts.append(inside.sum())
+    return np.array(sums), np.array(counts)
+
+
+GEOMETRIES = gp.GeoSeries([Point(8, -8).buffer(3), Point(20, -20).buffer(6), Point(15, -15).buffer(4), box(30, -39, 39, -30), None])
+
+
+@pytest.mark.parametrize('block_size', [None, 5, 64])
+def test_zonal_sum_matches_pixel_centres_for_any_block_size(block_size):
+    raster = get_raster()
+
+    sums, counts = zonal_sum(raster, GEOMETRIES, block_size=block_size)
+
+    expected_sums, expected_counts = get_brute_force_sums(raster, GEOMETRIES[:-1])
+    assert sums[:-1] == pytest.approx(expected_sums)
+    assert counts[:-1].tolist() == expected_counts.tolist()
+    assert (sums[-1], counts[-1]) == (0, 0)
+
+
+def test_nodata_pixels_count_as_covered_pixels_of_value_zero():
+    # the first geometry lies in a block holding nodata only
+    sums, counts = zonal_sum(get_raster(), GEOMETRIES[:1])
+    assert sums[0] == 0
+    assert counts[0] > 0
+
+
+def test_blocks_outside_windows_are_not_read():
+    raster = get_raster()
+    windows = get_raster_windows(raster, GEOMETRIES[3:4])
+
+    blocks = [window for window, values in iter_raster_blocks(raster, windows=windows)]
+
+    assert blocks == [(16, 28, 32, 32), (32, 28, 40, 32), (16, 32, 32, 36), (32, 32, 40, 36), (16, 36, 32, 40), (32, 36, 40, 40)]
+    assert raster.reads == [i[:2] for i in blocks]
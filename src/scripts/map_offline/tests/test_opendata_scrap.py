@@ -0,0 +1,121 @@
+"""LOAD DEPENDENCIES"""
+import json
+import re
+from functools import partial
+from urllib.parse import urlparse, parse_qs
+import pytest
+
+
+"""LOAD MODULES"""
+from conftest import respond
+from feature_engineering import configs
+from data_gathering import opendata_scrap
+from data_gathering.opendata_scrap import OSM_ID_OFFSET
+
+
+"""SCHOOLS SERVED BY THE OVERPASS STAND-IN; ways and relations are matched by their bounds and located by their centres"""
+ELEMENTS = [
+    {'type': 'node', 'id': 1, 'lat': 0.5, 'lon': 0.5, 'tags': {'amenity': 'school', 'name': 'node school'}},
+    {'type': 'node', 'id': 2, 'lat': 1.5, 'lon': 1.5, 'tags': {'amenity': 'school'}},
+    # way sharing its id with a node and crossing the tile border
+    {'type': 'way', 'id': 1, 'bounds': (0.4, 0.8, 0.6, 1.2), 'center': {'lat': 0.5, 'lon': 1.05}, 'tags': {'amenity': 'school', 'name': 'way school'}},
+    {'type': 'relation', 'id': 2, 'bounds': (1.3, 0.3, 1.7, 0.7), 'center': {'lat': 1.5, 'lon': 0.5}, 'tags': {'amenity': 'school'}},
+]
+
+QUARTERS = [(0, 0, 1, 1), (0, 1, 1, 2), (1, 0, 2, 1), (1, 1, 2, 2)]
+
+
+"""returns (south, west, north, east) bounds of the tile of an Overpass query path"""
+def get_query_tile(path):
+    query = parse_qs(urlparse(path).query)['data'][0]
+    return tuple(float(i) for i in re.search(r'\[bbox:([^\]]+)\]', query).group(1).split(','))
+
+
+"""answers Overpass queries of tiles up to max_size degrees with the elements within, larger tiles time out"""
+def get_overpass_handler(max_size=1):
+    def handle(request):
+        south, west, north, east = get_query_tile(request.path)
+        if north - south > max_size or east - west > max_size:
+            result = {'elements': [], 'remark': 'runtime error: Query timed out in "query" at line 4 after 180 seconds.'}
+        else:
+            elements = []
+            for elem in ELEMENTS:
+                s, w, n, e = elem.get('bounds', (elem.get('lat'), elem.get('lon'), elem.get('lat'), elem.get('lon')))
+                if s <= north and n >= south and w <= east and e >= west:
+                    elements.append({i: j for i, j in elem.items() if i != 'bounds'})
+            result = {'elements': elements}
+        respond(request, 200, json.dumps(result).encode(), {'Content-Type': 'application/json'})
+
+    return handle
+
+
+@pytest.fixture
+def overpass(server, monkeypatch, tmp_path):
+    server.handle = get_overpass_handler()
+    monkeypatch.setattr(opendata_scrap, 'OVERPASS_URL', server.url + '/api/interpreter')
+    monkeypatch.setattr(opendata_scrap, 'get_osm_tiles', lambda country_code, size: list(QUARTERS))
+    monkeypatch.setattr(opendata_scrap, 'osm_tiles_to_json', partial(opendata_scrap.osm_tiles_to_json, wd=str(tmp_path) + '/'))
+    monkeypatch.setattr(configs, 'OSM_MIN_INTERVAL', 0)
+    monkeypatch.setattr(configs, 'OSM_WORKERS', 4)
+
+    opendata_scrap.get_overpass_manager.cache_clear()
+    yield server
+    opendata_scrap.get_overpass_manager.cache_clear()
+
+
+def test_tile_is_split_on_timeout_remark(overpass, monkeypatch):
+    monkeypatch.setattr(opendata_scrap, 'get_osm_tiles', lambda country_code, size: [(0, 0, 2, 2)])
+
+    elements = opendata_scrap.osm_tiles_to_json('phl', max_splits=1)
+
+    tiles = [get_query_tile(i['path']) for i in overpass.requests]
+    assert tiles[0] == (0, 0, 2, 2)
+    assert sorted(tiles[1:]) == QUARTERS
+    assert {(i['type'], i['id']) for i in elements} == {(i['type'], i['id']) for i in ELEMENTS}
+
+
+def test_failing_tiles_raise_after_max_splits(overpass, monkeypatch):
+    monkeypatch.setattr(opendata_scrap, 'get_osm_tiles', lambda country_code, size: [(0, 0, 2, 2)])
+
+    with pytest.raises(RuntimeError):
+        opendata_scrap.osm_tiles_to_json('phl', max_splits=0)
+
+
+def test_schools_of_ways_and_relations_are_located_by_centre(overpass):
+    schools = opendata_scrap.get_osm_schools('phl', tags=['name']).set_index('source_school_id')
+
+    way = schools.loc[OSM_ID_OFFSET['way'] + 1]
+    assert (way.osm_type, way.latitude, way.longitude, way['name']) == ('way', 0.5, 1.05, 'way school')
+    relation = schools.loc[OSM_ID_OFFSET['relation'] + 2]
+    assert (relation.osm_type, relation.latitude, relation.longitude) == ('relation', 1.5, 0.5)
+
+
+def test_schools_are_deduplicated_across_tiles(overpass):
+    # the way crossing the tile border is returned by two tiles and shares its id with a node
+    elements = opendata_scrap.osm_tiles_to_json('phl')
+    assert sum((i['type'], i['id']) == ('way', 1) for i in elements) == 2
+
+    schools = opendata_scrap.get_osm_schools('phl')
+    assert len(schools) == len(ELEMENTS)
+    assert schools.source_school_id.is_unique
+    assert sorted(schools.osm_type.astype(str)) == ['node', 'node', 'relation', 'way']
+
+
+def test_tile_responses_are_cached(overpass):
+    first = opendata_scrap.osm_tiles_to_json('phl')
+    assert len(overpass.requests) == len(QUARTERS)
+
+    second = opendata_scrap.osm_tiles_to_json('phl')
+    assert len(overpass.requests) == len(QUARTERS)
+    assert sorted(json.dumps(i, sort_keys=True) for i in second) == sorted(json.dumps(i, sort_keys=True) for i in first)
+
+
+def test_query_starts_are_spaced_by_min_interval(overpass, monkeypatch, clock):
+    monkeypatch.setattr(configs, 'OSM_MIN_INTERVAL', 0.5)
+    opendata_scrap.get_overpass_manager.cache_clear()
+
+    opendata_scrap.osm_tiles_to_json('phl')
+
+    # the frozen clock makes every query wait for its slot from the same instant
+    assert len(overpass.requests) == len(QUARTERS)
+    assert sorted(clock.sleeps) == pytest.approx([0, 0.5, 1, 1.5])
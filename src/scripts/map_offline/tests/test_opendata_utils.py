@@ -0,0 +1,58 @@
+"""LOAD DEPENDENCIES"""
+import numpy as np
+import geopandas as gp
+import pytest
+from shapely.geometry import LineString
+from shapely.ops import unary_union, polygonize
+
+
+"""LOAD MODULES"""
+from data_gathering import opendata_utils
+from feature_engineering import configs
+from data_gathering.opendata_utils import get_simplified, simplify_coverage_edges, migrate_legacy_cache, get_satellite_cache_name, get_legacy_satellite_cache_name
+
+
+"""returns a coverage of size x size areas on the unit square whose shared edges are jagged"""
+def get_jagged_coverage(size=4, points=200):
+    rng = np.random.default_rng(0)
+    steps = np.linspace(0, 1, points)
+    lines = []
+    for k in range(size + 1):
+        jitter = rng.normal(0, 0.002, (2, points)) if 0 < k < size else np.zeros((2, points))
+        lines.append(LineString(np.c_[k / size + jitter[0], steps]))
+        lines.append(LineString(np.c_[steps, k / size + jitter[1]]))
+    return gp.GeoDataFrame({'area': range(size ** 2)}, geometry=list(polygonize(unary_union(lines))), crs='EPSG:4326')
+
+
+def test_edges_shared_by_areas_stay_aligned():
+    coverage = get_jagged_coverage()
+
+    simplified = gp.GeoSeries(simplify_coverage_edges(coverage.geometry, 0.01), crs=coverage.crs)
+
+    assert sum(len(i.exterior.coords) for i in simplified) < sum(len(i.exterior.coords) for i in coverage.geometry) / 10
+    assert simplified.is_valid.all()
+    # no overlaps and no gaps between neighbouring areas
+    assert sum(i.area for i in simplified) == pytest.approx(unary_union(list(simplified)).area)
+    assert unary_union(list(simplified)).area == pytest.approx(1)
+
+
+def test_overlapping_areas_are_not_simplified(tmp_path, monkeypatch):
+    monkeypatch.setattr(opendata_utils, 'report_simplification', lambda original, simplified: None)
+    coverage = get_jagged_coverage()
+    overlapping = coverage.copy()
+    overlapping.loc[0, 'geometry'] = overlapping.geometry[0].buffer(0.01)
+
+    assert get_simplified(overlapping, str(tmp_path / 'overlapping.csv'), 0.01) is overlapping
+    assert len(get_simplified(coverage, str(tmp_path / 'coverage.csv'), 0.01)) == len(coverage)
+
+
+def test_legacy_cache_is_renamed_when_built_with_same_config(tmp_path):
+    wd = str(tmp_path) + '/'
+    config = ('bra', configs.SATELITTE_COLLECTIONS, 2014, 2019, 5, 30)
+    (tmp_path / 'satellite_bra.csv').write_text('source_school_id\n1\n')
+
+    migrate_legacy_cache(wd, get_satellite_cache_name(*config), get_legacy_satellite_cache_name(*config))
+
+    assert not (tmp_path / 'satellite_bra.csv').exists()
+    assert (tmp_path / get_satellite_cache_name(*config)).read_text() == 'source_school_id\n1\n'
+    assert get_legacy_satellite_cache_name('bra', configs.SATELITTE_COLLECTIONS, 2014, 2020, 5, 30) is None
@@ -19,6 +19,7 @@ from datetime import datetime, date
 from tqdm.notebook import tqdm
 from sklearn import datasets
 from sklearn.datasets import load_diabetes
+from training_data import read_training_set
 
 # save runs
 mlflow.set_tracking_uri("file:///files/mlruns")
@@ -57,7 +58,7 @@ print("#####################################################")
 
 # import data
 dataset = '../../' + model_config['model']['loc'] + model_config['model']['file']
-dataset = pd.read_csv(dataset)
+dataset = read_training_set(dataset, model_config['meta']['predictors'] + model_config['meta']['target'])
 
 print("#####################################################")
 print("training data loaded")
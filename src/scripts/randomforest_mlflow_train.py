@@ -10,6 +10,7 @@ from sklearn.ensemble import RandomForestRegressor
 from sklearn.model_selection import train_test_split, KFold, RandomizedSearchCV, GridSearchCV
 from sklearn.metrics import make_scorer
 from datetime import datetime, date
+from training_data import read_training_set
 
 # start time
 begin_time = datetime.now()
@@ -42,7 +43,7 @@ print("#####################################################")
 
 # import data
 dataset = '../../' + model_config['model']['loc'] + model_config['model']['file']
-dataset = pd.read_csv(dataset)
+dataset = read_training_set(dataset, model_config['meta']['predictors'] + model_config['meta']['target'])
 
 print("#####################################################")
 print("training data loaded")
@@ -0,0 +1,17 @@
+# load libraries
+import os
+import pandas as pd
+
+
+# read training set with only the given columns; the float32 feather matrix written next to the csv
+# by the feature pipeline is memory-mapped if it exists, otherwise only the given csv columns are parsed.
+# columns of the matrix are read-only views of the memory map rather than copies, copy the frame to modify it
+def read_training_set(path, columns):
+    columns = list(dict.fromkeys(columns))
+    matrix_path = os.path.splitext(path)[0] + '.feather'
+
+    if os.path.exists(matrix_path):
+        from pyarrow import feather
+        return feather.read_table(matrix_path, columns=columns, memory_map=True).to_pandas(split_blocks=True, self_destruct=True)
+
+    return pd.read_csv(path, usecols=columns)
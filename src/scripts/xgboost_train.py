@@ -9,6 +9,7 @@ from sklearn.model_selection import train_test_split, KFold, RandomizedSearchCV,
 from sklearn.metrics import make_scorer
 from datetime import datetime, date
 import subprocess
+from training_data import read_training_set
 
 # start time
 begin_time = datetime.now()
@@ -23,7 +24,7 @@ print("#####################################################")
 
 # import data
 dataset = '../../' + model_config['model']['loc'] + model_config['model']['file']
-dataset = pd.read_csv(dataset)
+dataset = read_training_set(dataset, model_config['meta']['predictors'] + model_config['meta']['target'])
 
 print("#####################################################")
 print("training data loaded")